@@ -1,10 +1,28 @@
 import os
 import logging
 import psycopg2
+import psycopg2.errors
+import psycopg2.extras
 import random
 import asyncio
 import uuid
+import json
+import gzip
+import hmac
+import queue
+import tempfile
+import csv
+import io
 import string
+import threading
+import time
+import functools
+import bisect
+import heapq
+import re
+import importlib.util
+from collections import OrderedDict
+from array import array
 import uvicorn
 from datetime import datetime, date, timedelta
 from contextlib import asynccontextmanager
@@ -12,7 +30,7 @@ import pytz
 
 # Web Server
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 # Telegram
@@ -33,8 +51,13 @@ from telegram.ext import (
     ContextTypes,
     filters,
     ConversationHandler,
+    BasePersistence,
+    BaseRateLimiter,
+    PersistenceInput,
 )
-from telegram.error import BadRequest
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
+from telegram.helpers import escape_markdown
 
 # ==============================================================================
 # 配置区域
@@ -52,10 +75,65 @@ CONFIG = {
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = os.getenv("ADMIN_ID")
 DATABASE_URL = os.getenv("DATABASE_URL")
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")  # 只读副本，不配置则全部走主库
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))  # 每个进程常驻的连接数 (主库/副本各一池)
+DB_PREPARE = os.getenv("DB_PREPARE", "1") == "1"  # 连接上预编译热点语句
+DB_POOL_PING_IDLE = int(os.getenv("DB_POOL_PING_IDLE", "10"))  # 空闲超过该秒数的连接借出前先探测
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))  # 写后该时间内读主库
 raw_domain = os.getenv("RAILWAY_PUBLIC_DOMAIN", "")
 RAILWAY_DOMAIN = raw_domain.replace("https://", "").replace("http://", "").strip("/")
 DIRECT_LINK_1 = "https://otieu.com/4/10489994"
 DIRECT_LINK_2 = "https://otieu.com/4/10489998"
+CLICK_FLUSH_SECONDS = int(os.getenv("CLICK_FLUSH_SECONDS", "30"))
+STATS_FLUSH_SECONDS = int(os.getenv("STATS_FLUSH_SECONDS", "30"))  # 运营统计计数在内存中累积，按此间隔写回
+STATS_ACTIVE_RETENTION_DAYS = int(os.getenv("STATS_ACTIVE_RETENTION_DAYS", "7"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", os.getenv("COOLDOWN_CACHE_TTL", "300")))  # 用户状态缓存有效期 (秒)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "20000"))  # 最多缓存的用户数 (LRU)
+KNOWN_USERS_MERGE_AT = int(os.getenv("KNOWN_USERS_MERGE_AT", "1000"))  # 新注册用户攒到该数量即并入有序数组
+EDIT_TRACK_SIZE = int(os.getenv("EDIT_TRACK_SIZE", "20000"))  # 记录最近渲染内容的消息数
+KEYS_CACHE_TTL = int(os.getenv("KEYS_CACHE_TTL", "60"))  # 密钥行进程内缓存 (秒)，修改时主动失效
+SHARED_CACHE_TTL = float(os.getenv("SHARED_CACHE_TTL", "10"))  # 商品首页/命令内容等共享查询的短期缓存 (秒)
+SHARED_CACHE_SIZE = int(os.getenv("SHARED_CACHE_SIZE", "2000"))
+VIP_DAILY_FREE = 5
+POINT_LOG_RETENTION_MONTHS = int(os.getenv("POINT_LOG_RETENTION_MONTHS", "12"))  # 0 = 不归档
+POINT_LOG_ARCHIVE_SCHEMA = "point_logs_archive"
+# 临时数据清理：每批删除行数、批间暂停秒数与各表保留期
+JANITOR_BATCH = int(os.getenv("JANITOR_BATCH", "1000"))
+JANITOR_PAUSE = float(os.getenv("JANITOR_PAUSE", "0.2"))
+AD_TOKEN_TTL_HOURS = int(os.getenv("AD_TOKEN_TTL_HOURS", "24"))
+KEY_CLAIM_RETENTION_DAYS = int(os.getenv("KEY_CLAIM_RETENTION_DAYS", "30"))
+FILE_ID_RETENTION_DAYS = int(os.getenv("FILE_ID_RETENTION_DAYS", "90"))
+
+# 多进程 / 多副本部署：WEB_CONCURRENCY > 1 时默认开启集群模式
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+CLUSTER_MODE = os.getenv("CLUSTER_MODE", "1" if WEB_CONCURRENCY > 1 else "0") == "1"
+LEADER_LOCK_KEY = 73_000_001
+INIT_LOCK_KEY = 73_000_002
+LEADER_CHECK_SECONDS = int(os.getenv("LEADER_CHECK_SECONDS", "15"))
+CACHE_CHANNEL = "weeguard_cache"
+INSTANCE_ID = uuid.uuid4().hex[:12]
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "15"))
+PERSISTENCE_RETRY_MAX = float(os.getenv("PERSISTENCE_RETRY_MAX", "60"))  # 落库失败后重试的最大退避秒数
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN")  # HTTP 管理接口 (导出/统计) 的访问令牌，只认 X-Export-Token 请求头，不配置则关闭
+EXPORT_LINK_TTL = int(os.getenv("EXPORT_LINK_TTL", "600"))  # 聊天里下发的一次性导出链接有效期 (秒)
+
+# Bot API 连接：发送与 get_updates 分用两个连接池
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "0"))  # >0 时并发处理更新
+BOT_POOL_SIZE = int(os.getenv("BOT_POOL_SIZE", str(max(16, CONCURRENT_UPDATES * 2))))
+BOT_CONNECT_TIMEOUT = float(os.getenv("BOT_CONNECT_TIMEOUT", "5"))
+BOT_READ_TIMEOUT = float(os.getenv("BOT_READ_TIMEOUT", "10"))
+BOT_WRITE_TIMEOUT = float(os.getenv("BOT_WRITE_TIMEOUT", "20"))  # 发图/视频上传
+BOT_POOL_TIMEOUT = float(os.getenv("BOT_POOL_TIMEOUT", "5"))
+SEND_RATE = float(os.getenv("SEND_RATE", "25"))  # 全局每秒发送上限 (Telegram 约 30/s)
+ADMIN_DIGEST_WINDOW = float(os.getenv("ADMIN_DIGEST_WINDOW", "5"))  # 管理员通知合并窗口 (秒)
+ADMIN_OUTBOX_MAX = 200  # 积压超过这个数时丢最早的，并在摘要里注明丢了几条
+ADMIN_MESSAGE_LIMIT = 3800  # 单条摘要正文上限 (Telegram 4096，留出标题余量)
+ADMIN_DIGEST_MAX_ATTEMPTS = 5  # 网络类错误最多重试几个窗口，之后丢弃积压
+CHAT_SEND_INTERVAL = float(os.getenv("CHAT_SEND_INTERVAL", "1"))  # 同一会话非交互消息的最小间隔 (秒)
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))  # get_updates 长轮询秒数
+# auto: 装了 h2 才启用 HTTP/2
+BOT_HTTP2 = os.getenv("BOT_HTTP2", "auto")
+BOT_HTTP2 = importlib.util.find_spec("h2") is not None if BOT_HTTP2 == "auto" else BOT_HTTP2 == "1"
 
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -68,22 +146,202 @@ bot_app = None
 WAITING_FOR_PHOTO = 1
 WAITING_LINK_1 = 2; WAITING_LINK_2 = 3; WAITING_LINK_3 = 4; WAITING_LINK_4 = 5; WAITING_LINK_5 = 6; WAITING_LINK_6 = 7; WAITING_LINK_7 = 8
 WAITING_CMD_NAME = 30; WAITING_CMD_CONTENT = 31
-WAITING_PROD_NAME = 40; WAITING_PROD_PRICE = 41; WAITING_PROD_CONTENT = 42
+WAITING_PROD_NAME = 40; WAITING_PROD_PRICE = 41; WAITING_PROD_CONTENT = 42; WAITING_PROD_IMPORT = 43
 WAITING_START_ORDER = 10; WAITING_VIP_ORDER = 20; WAITING_RECHARGE_ORDER = 25
 
 # ==============================================================================
 # 数据库初始化
 # ==============================================================================
 
+# --- 连接池与预编译语句 ---
+# helper 统一写成 with get_db_connection() as conn: ...，退出 with 时 (含异常路径)
+# 回滚未提交事务并把连接还回池中；重复 close() 无害。
+# 池里只保存空闲连接，借出的连接不留引用：万一有路径漏还，由 GC 关闭而不是一直占着。
+_pools = {}
+_pools_lock = threading.Lock()
+PREPARED_SQL = {}  # 名称 -> %s 占位的 SQL
+
+def register_prepared(name, sql):
+    PREPARED_SQL[name] = sql
+
+class PooledConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool = None  # 借出时所属的池；直连为 None
+        self._idle = False  # 正在池中空闲
+        self._idle_since = 0.0
+        self._prepared = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def close(self):
+        if self._idle:
+            return  # 已归还：不能关掉之后被别的线程借走的连接
+        pool, self._pool = self._pool, None
+        if pool is None:
+            return super().close()
+        pool.release(self)
+
+class ConnectionPool:
+    """空闲连接栈 (最多 size 个)；借空时直接新建，不设借出上限"""
+
+    def __init__(self, dsn, size, readonly=False, **kwargs):
+        self.dsn, self.size, self.readonly, self.kwargs = dsn, size, readonly, kwargs
+        self.idle = []
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def connect(self):
+        conn = psycopg2.connect(self.dsn, connection_factory=PooledConnection, **self.kwargs)
+        if self.readonly:
+            conn.set_session(readonly=True)
+        return conn
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                return self.connect()
+            conn._idle = False
+            if not conn.closed and (time.monotonic() - conn._idle_since < DB_POOL_PING_IDLE or _ping(conn)):
+                return conn
+            self.discard(conn)
+
+    def release(self, conn):
+        ok = not conn.closed
+        if ok:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except psycopg2.Error:
+                ok = False
+        if not ok:
+            # 连接断了多半是数据库重启/网络中断，其余空闲连接也不可信
+            self.discard(conn)
+            self.flush()
+            return
+        with self.lock:
+            if not self.closed and len(self.idle) < self.size:
+                conn._idle, conn._idle_since = True, time.monotonic()
+                self.idle.append(conn)
+                return
+        self.discard(conn)
+
+    def discard(self, conn):
+        conn._idle = False
+        try:
+            psycopg2.extensions.connection.close(conn)
+        except psycopg2.Error:
+            pass
+
+    def flush(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            self.discard(conn)
+
+    def close(self):
+        self.closed = True
+        self.flush()
+
+def _ping(conn):
+    """空闲较久的连接借出前探测一次，失效则换一条，不让真实请求去撞断线"""
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _prepare_statements(conn):
+    cur = conn.cursor()
+    try:
+        cur.execute("DEALLOCATE ALL")
+        for name, sql in PREPARED_SQL.items():
+            n = iter(range(1, 100))
+            cur.execute(f"PREPARE {name} AS " + re.sub(r"%s", lambda m: f"${next(n)}", sql))
+        conn.commit()
+        conn._prepared = True
+    except psycopg2.Error as e:
+        # 启动时表尚未建好等情况，下次借出时再试
+        conn.rollback()
+        logger.warning(f"prepare statements failed: {e}")
+    finally:
+        cur.close()
+
+def _checkout(dsn, readonly=False, **kwargs):
+    with _pools_lock:
+        pool = _pools.get(dsn)
+        if pool is None:
+            pool = _pools[dsn] = ConnectionPool(dsn, DB_POOL_SIZE, readonly=readonly, **kwargs)
+    conn = pool.acquire()
+    if DB_PREPARE and not conn._prepared:
+        _prepare_statements(conn)
+    conn._pool = pool
+    return conn
+
+def run_prepared(cur, name, args=()):
+    """已预编译的连接上 EXECUTE，否则 (直连/关闭预编译) 直接执行原 SQL"""
+    if getattr(cur.connection, "_prepared", False):
+        cur.execute(f"EXECUTE {name}" + (f" ({', '.join(['%s'] * len(args))})" if args else ""), args)
+    else:
+        cur.execute(PREPARED_SQL[name], args)
+
+def close_db_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
 def get_db_connection():
-    return psycopg2.connect(DATABASE_URL)
+    return _checkout(DATABASE_URL)
+
+# --- 读副本路由 ---
+# 用户自己刚写过 (或管理员刚改过商品/命令) 的短窗口内读主库，避免副本延迟读到旧数据。
+_recent_writes = {}  # user_id (None = 全局共享数据) -> 窗口截止 (monotonic)
+_recent_writes_lock = threading.Lock()
+
+def note_write(user_id=None):
+    if not DATABASE_REPLICA_URL:
+        return
+    now = time.monotonic()
+    with _recent_writes_lock:
+        if len(_recent_writes) > 50000:
+            for k in [k for k, v in _recent_writes.items() if v <= now]:
+                del _recent_writes[k]
+        _recent_writes[user_id] = now + READ_YOUR_WRITES_SECONDS
+
+def get_read_connection(user_id=None):
+    """只读查询用的连接：有副本且不在写后窗口内时连副本，副本不可用回退主库"""
+    if not DATABASE_REPLICA_URL or _recent_writes.get(user_id, 0) > time.monotonic():
+        return get_db_connection()
+    try:
+        return _checkout(DATABASE_REPLICA_URL, readonly=True, connect_timeout=3)
+    except psycopg2.OperationalError as e:
+        logger.warning(f"replica unavailable, reading from primary: {e}")
+        return get_db_connection()
 
 def init_db():
-    conn = get_db_connection()
+    # 建表/迁移用独立直连：池中连接上的预编译语句不应绑定到迁移前的旧表
+    conn = psycopg2.connect(DATABASE_URL)
     cur = conn.cursor()
+    # 多个 worker 同时启动时串行执行建表
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (INIT_LOCK_KEY,))
     
     # 基础表 V3
     cur.execute("CREATE TABLE IF NOT EXISTS file_ids_v3 (id SERIAL PRIMARY KEY, file_id TEXT, file_unique_id TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);")
+    cur.execute("ALTER TABLE file_ids_v3 ADD COLUMN IF NOT EXISTS asset_key TEXT;")
+    cur.execute("CREATE INDEX IF NOT EXISTS file_ids_v3_asset_idx ON file_ids_v3 (asset_key, id) WHERE asset_key IS NOT NULL;")
     
     # 用户表 V3
     cur.execute("""
@@ -100,6 +358,8 @@ def init_db():
             vip_buy_fails INTEGER DEFAULT 0, vip_buy_lock TIMESTAMP, verify_unlock_date DATE
         );
     """)
+    cur.execute("CREATE INDEX IF NOT EXISTS users_v3_points_idx ON users_v3 (points DESC, user_id DESC);")
+    cur.execute("CREATE INDEX IF NOT EXISTS users_v3_vip_points_idx ON users_v3 (points DESC, user_id DESC) WHERE vip_expire IS NOT NULL;")
     cols = ["verify_fails INT DEFAULT 0", "verify_lock TIMESTAMP", "verify_done BOOLEAN DEFAULT FALSE",
             "wx_fails INT DEFAULT 0", "wx_lock TIMESTAMP", "wx_done BOOLEAN DEFAULT FALSE",
             "ali_fails INT DEFAULT 0", "ali_lock TIMESTAMP", "ali_done BOOLEAN DEFAULT FALSE",
@@ -109,6 +369,21 @@ def init_db():
     for c in cols:
         try: cur.execute(f"ALTER TABLE users_v3 ADD COLUMN IF NOT EXISTS {c};")
         except: conn.rollback()
+    cur.execute("CREATE INDEX IF NOT EXISTS users_v3_username_idx ON users_v3 (lower(username) text_pattern_ops);")
+
+    # 冷却/锁状态 (user, flow)，首次创建时从 users_v3 旧列迁移
+    cur.execute("SELECT to_regclass('user_cooldowns_v8')")
+    migrate_cooldowns = cur.fetchone()[0] is None
+    cur.execute("CREATE TABLE IF NOT EXISTS user_cooldowns_v8 (user_id BIGINT NOT NULL, flow TEXT NOT NULL, fails INT DEFAULT 0, lock_until TIMESTAMP, done BOOLEAN DEFAULT FALSE, PRIMARY KEY (user_id, flow));")
+    if migrate_cooldowns:
+        for flow in ('verify', 'wx', 'ali', 'vip_buy'):
+            done_col = f"COALESCE({flow}_done, FALSE)" if flow != 'vip_buy' else "FALSE"
+            cur.execute(f"""
+                INSERT INTO user_cooldowns_v8 (user_id, flow, fails, lock_until, done)
+                SELECT user_id, '{flow}', COALESCE({flow}_fails, 0), {flow}_lock, {done_col} FROM users_v3
+                WHERE COALESCE({flow}_fails, 0) > 0 OR {flow}_lock IS NOT NULL OR {done_col}
+                ON CONFLICT (user_id, flow) DO NOTHING
+            """)
 
     # 业务表
     cur.execute("CREATE TABLE IF NOT EXISTS user_ads_v3 (user_id BIGINT PRIMARY KEY, last_watch_date DATE, daily_watch_count INT DEFAULT 0);")
@@ -124,7 +399,13 @@ def init_db():
         );
     """)
     cur.execute("INSERT INTO system_keys_v7 (id) VALUES (1) ON CONFLICT (id) DO NOTHING")
-    cur.execute("CREATE TABLE IF NOT EXISTS user_used_keys_v7 (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, key_index INTEGER NOT NULL, used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, UNIQUE(user_id, key_index));")
+    cur.execute("CREATE TABLE IF NOT EXISTS user_used_keys_v7 (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, key_index INTEGER NOT NULL, used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, epoch INTEGER NOT NULL DEFAULT 0);")
+    # 密钥轮换按 epoch 区分，唯一约束改为 (user_id, key_index, epoch)
+    cur.execute("ALTER TABLE system_keys_v7 ADD COLUMN IF NOT EXISTS epoch INTEGER NOT NULL DEFAULT 0;")
+    cur.execute("ALTER TABLE user_used_keys_v7 ADD COLUMN IF NOT EXISTS epoch INTEGER NOT NULL DEFAULT 0;")
+    cur.execute("ALTER TABLE user_used_keys_v7 DROP CONSTRAINT IF EXISTS user_used_keys_v7_user_id_key_index_key;")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS user_used_keys_v7_epoch_uq ON user_used_keys_v7 (user_id, key_index, epoch);")
+    cur.execute("CREATE INDEX IF NOT EXISTS user_used_keys_v7_epoch_idx ON user_used_keys_v7 (epoch, id);")
     
     cur.execute("CREATE TABLE IF NOT EXISTS user_key_clicks_v3 (user_id BIGINT PRIMARY KEY, click_count INT DEFAULT 0, session_date DATE);")
     cur.execute("CREATE TABLE IF NOT EXISTS user_key_claims_v3 (id SERIAL PRIMARY KEY, user_id BIGINT, key_val TEXT, claimed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, UNIQUE(user_id, key_val));")
@@ -134,185 +415,870 @@ def init_db():
 
     cur.execute("CREATE TABLE IF NOT EXISTS products_v5 (id SERIAL PRIMARY KEY, name TEXT NOT NULL, price INTEGER NOT NULL, content_text TEXT, content_file_id TEXT, content_type TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);")
     cur.execute("CREATE TABLE IF NOT EXISTS user_purchases_v5 (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, product_id INTEGER REFERENCES products_v5(id) ON DELETE CASCADE, purchase_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, UNIQUE(user_id, product_id));")
-    cur.execute("CREATE TABLE IF NOT EXISTS point_logs_v5 (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, change_amount INTEGER NOT NULL, reason TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);")
+    cur.execute("CREATE TABLE IF NOT EXISTS stats_hourly_v8 (bucket TIMESTAMP NOT NULL, metric TEXT NOT NULL, dim TEXT NOT NULL DEFAULT '', value BIGINT NOT NULL DEFAULT 0, PRIMARY KEY (bucket, metric, dim));")
+    cur.execute("CREATE TABLE IF NOT EXISTS stats_active_v8 (day DATE NOT NULL, user_id BIGINT NOT NULL, PRIMARY KEY (day, user_id));")
+    cur.execute("CREATE TABLE IF NOT EXISTS bot_persistence_v8 (kind TEXT NOT NULL, key TEXT NOT NULL, data TEXT NOT NULL, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (kind, key));")
+    # 积分日志按月分区；旧的普通表整体挂成一个历史分区，序列改为独立对象 (归档旧分区时不被连带删除)
+    cur.execute("SELECT c.relkind FROM pg_class c WHERE c.oid = to_regclass('point_logs_v5')")
+    row = cur.fetchone()
+    if row and row[0] == 'r':
+        first_month = bj_today().replace(day=1)
+        next_month = (first_month + timedelta(days=32)).replace(day=1)
+        cur.execute("ALTER TABLE point_logs_v5 RENAME TO point_logs_v5_legacy;")
+        cur.execute("ALTER TABLE point_logs_v5_legacy RENAME CONSTRAINT point_logs_v5_pkey TO point_logs_v5_legacy_pkey;")
+        cur.execute("ALTER SEQUENCE point_logs_v5_id_seq OWNED BY NONE;")
+        cur.execute("UPDATE point_logs_v5_legacy SET created_at = '1970-01-01' WHERE created_at IS NULL;")
+        cur.execute("ALTER TABLE point_logs_v5_legacy ALTER COLUMN created_at SET NOT NULL;")
+    cur.execute("CREATE SEQUENCE IF NOT EXISTS point_logs_v5_id_seq;")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS point_logs_v5 (
+            id INTEGER NOT NULL DEFAULT nextval('point_logs_v5_id_seq'),
+            user_id BIGINT NOT NULL, change_amount INTEGER NOT NULL, reason TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at);
+    """)
+    if row and row[0] == 'r':
+        cur.execute("ALTER TABLE point_logs_v5 ATTACH PARTITION point_logs_v5_legacy FOR VALUES FROM (MINVALUE) TO (%s)", (next_month,))
+    cur.execute("CREATE TABLE IF NOT EXISTS point_logs_v5_default PARTITION OF point_logs_v5 DEFAULT;")
+    cur.execute("CREATE INDEX IF NOT EXISTS point_logs_v5_user_idx ON point_logs_v5 (user_id, created_at DESC);")
+    ensure_point_log_partitions(cur)
+
+    # 积分汇总：按类别累计 + 最近 N 条，写积分时同事务增量维护；首次创建时从日志回填
+    cur.execute("SELECT to_regclass('point_summary_v8')")
+    backfill_summary = cur.fetchone()[0] is None
+    cur.execute("SELECT to_regclass('point_recent_v8')")
+    backfill_recent = cur.fetchone()[0] is None
+    cur.execute("CREATE TABLE IF NOT EXISTS point_summary_v8 (user_id BIGINT NOT NULL, category TEXT NOT NULL, total BIGINT NOT NULL DEFAULT 0, entries INT NOT NULL DEFAULT 0, PRIMARY KEY (user_id, category));")
+    cur.execute("CREATE TABLE IF NOT EXISTS point_recent_v8 (user_id BIGINT PRIMARY KEY, entries JSONB NOT NULL DEFAULT '[]'::jsonb);")
+    if backfill_summary:
+        cur.execute("""
+            INSERT INTO point_summary_v8 (user_id, category, total, entries)
+            SELECT user_id, split_part(COALESCE(reason, ''), '-', 1), SUM(change_amount), COUNT(*) FROM point_logs_v5 GROUP BY 1, 2
+        """)
+    if backfill_recent:
+        cur.execute(f"""
+            INSERT INTO point_recent_v8 (user_id, entries)
+            SELECT user_id, jsonb_agg({POINT_RECENT_ENTRY} ORDER BY rn) FROM (
+                SELECT l.*, row_number() OVER (PARTITION BY user_id ORDER BY created_at DESC, id DESC) AS rn FROM point_logs_v5 l
+            ) l WHERE rn <= %s GROUP BY user_id
+        """, (POINT_RECENT_SIZE,))
+    cur.execute("""
+        CREATE MATERIALIZED VIEW IF NOT EXISTS point_category_totals_mv AS
+        SELECT category, SUM(total)::bigint AS total, SUM(entries)::bigint AS entries, COUNT(*)::bigint AS users
+        FROM point_summary_v8 GROUP BY category
+    """)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS point_category_totals_mv_uq ON point_category_totals_mv (category);")
 
     conn.commit()
     cur.close()
     conn.close()
+
+# ==============================================================================
+# 集群：跨进程缓存失效 (LISTEN/NOTIFY)
+# ==============================================================================
+
+_invalidation_handlers = {}  # scope -> fn(arg)
+_listener = {"conn": None}
+
+def register_invalidation(scope, fn):
+    _invalidation_handlers[scope] = fn
+
+def notify_invalidation(cur, scope, arg=""):
+    """在当前事务内广播缓存失效，提交时才会送达其它进程"""
+    if CLUSTER_MODE:
+        cur.execute("SELECT pg_notify(%s, %s)", (CACHE_CHANNEL, f"{INSTANCE_ID}|{scope}|{arg}"))
+
+def _on_cache_notify():
+    conn = _listener["conn"]
+    try:
+        conn.poll()
+    except Exception as e:
+        logger.warning(f"cache listener lost: {e}")
+        asyncio.get_running_loop().remove_reader(conn.fileno())
+        _listener["conn"] = None
+        return
+    while conn.notifies:
+        origin, scope, arg = conn.notifies.pop(0).payload.split("|", 2)
+        fn = _invalidation_handlers.get(scope)
+        if origin != INSTANCE_ID and fn:
+            try:
+                fn(arg)
+            except Exception as e:
+                logger.warning(f"invalidation {scope} failed: {e}")
+
+def ensure_cache_listener():
+    """建立 LISTEN 专用连接并挂到事件循环上 (断线后由选举循环重建)"""
+    if not CLUSTER_MODE or (_listener["conn"] and not _listener["conn"].closed):
+        return
+    conn = psycopg2.connect(DATABASE_URL)
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    conn.cursor().execute(f"LISTEN {CACHE_CHANNEL};")
+    _listener["conn"] = conn
+    asyncio.get_running_loop().add_reader(conn.fileno(), _on_cache_notify)
+
     # ==============================================================================
 # 业务逻辑函数
 # ==============================================================================
 
+# --- 共享查询：单飞 + 短期缓存 ---
+# 同一 key 的并发查询只放行一个去查库，其余线程等待并共享结果 (或异常)
+_inflight = {}  # key -> [Event, result, exc]
+_inflight_lock = threading.Lock()
+_shared_cache = {}  # scope -> OrderedDict(key -> (value, expires))，各 scope 独立按 LRU 淘汰
+_shared_gen = {}  # scope -> 失效代数，查询期间发生写入则不回填缓存
+
+def single_flight(key, fn, *args):
+    with _inflight_lock:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _inflight[key] = [threading.Event(), None, None]
+    if not leader:
+        call[0].wait()
+        if call[2]:
+            raise call[2]
+        return call[1]
+    try:
+        call[1] = fn(*args)
+        return call[1]
+    except Exception as e:
+        call[2] = e
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+        call[0].set()
+
+def cached_lookup(scope, key, fn, *args):
+    with _inflight_lock:
+        entries = _shared_cache.get(scope)
+        hit = entries.get(key) if entries else None
+        if hit and time.monotonic() < hit[1]:
+            entries.move_to_end(key)
+            return hit[0]
+
+    def load():
+        gen = _shared_gen.get(scope, 0)
+        value = fn(*args)
+        with _inflight_lock:
+            if _shared_gen.get(scope, 0) == gen:
+                entries = _shared_cache.setdefault(scope, OrderedDict())
+                entries[key] = (value, time.monotonic() + SHARED_CACHE_TTL)
+                entries.move_to_end(key)
+                if len(entries) > SHARED_CACHE_SIZE:
+                    entries.popitem(last=False)
+        return value
+    return single_flight((scope, key), load)
+
+def drop_shared_cache(scope=""):
+    """本进程或其它进程改了共享数据：清掉该 scope，并在写后窗口内改读主库，避免从副本回填旧数据"""
+    with _inflight_lock:
+        _shared_gen[scope] = _shared_gen.get(scope, 0) + 1
+        _shared_cache.pop(scope, None)
+    note_write()
+
+register_invalidation('shared', drop_shared_cache)
+
+_session_cache = {"date": None, "until": None}
+
 def get_session_date():
+    """以每天 10:00 为界的会话日期，只在跨过边界时重新计算"""
     now = datetime.now(tz_bj)
-    if now.hour < 10: return (now - timedelta(days=1)).date()
-    return now.date()
+    if _session_cache["until"] is None or now >= _session_cache["until"]:
+        boundary = now.replace(hour=10, minute=0, second=0, microsecond=0)
+        if now < boundary:
+            _session_cache["date"] = (now - timedelta(days=1)).date()
+            _session_cache["until"] = boundary
+        else:
+            _session_cache["date"] = now.date()
+            _session_cache["until"] = boundary + timedelta(days=1)
+    return _session_cache["date"]
+
+def bj_today():
+    return datetime.now(tz_bj).date()
+
+# --- 每日额度 (按北京时间惰性归零，不做零点批量重置) ---
+# quota: (表, 计数列, 日期列)
+DAILY_QUOTAS = {
+    'free': ('users_v3', 'daily_free_count', 'last_free_date'),
+}
+
+def get_daily_quota(user_id, quota):
+    """今日已用次数，存储日期不是今天即视为 0"""
+    table, count_col, date_col = DAILY_QUOTAS[quota]
+    with get_read_connection(user_id) as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT CASE WHEN {date_col} = %s THEN {count_col} ELSE 0 END FROM {table} WHERE user_id=%s", (bj_today(), user_id))
+        row = cur.fetchone()
+        cur.close()
+    return row[0] if row else 0
+
+def consume_daily_quota(user_id, quota, limit):
+    """额度内原子 +1 (跨天自动从 1 开始)，返回新次数；额度已满返回 None"""
+    table, count_col, date_col = DAILY_QUOTAS[quota]
+    today = bj_today()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            INSERT INTO {table} AS t (user_id, {count_col}, {date_col}) VALUES (%(uid)s, 1, %(today)s)
+            ON CONFLICT (user_id) DO UPDATE SET
+                {count_col} = CASE WHEN t.{date_col} = %(today)s THEN t.{count_col} + 1 ELSE 1 END,
+                {date_col} = %(today)s
+            WHERE CASE WHEN t.{date_col} = %(today)s THEN t.{count_col} ELSE 0 END < %(limit)s
+            RETURNING {count_col}
+        """, {"uid": user_id, "today": today, "limit": limit})
+        row = cur.fetchone()
+        if row and table == 'users_v3':
+            notify_invalidation(cur, 'user', user_id)
+        conn.commit()
+        note_write(user_id)
+        cur.close()
+    if row and table == 'users_v3':
+        update_user_state(user_id, **{count_col: row[0], date_col: today})
+    return row[0] if row else None
 
 def generate_random_key():
     length = random.randint(6, 9)
     chars = string.ascii_letters + string.digits
     return ''.join(random.choices(chars, k=length))
 
+# --- 图片素材 (启动时校验一次，之后只读内存) ---
+ASSET_KEYS = [k for k in CONFIG if k != "GROUP_LINK"]
+_assets = {}  # key -> 已验证的 file_id，None 表示不可用
+
 def get_file_id(key):
+    if key in _assets:
+        return _assets[key]
     fid = CONFIG.get(key)
     return fid if fid and fid.startswith("AgAC") else None
 
+def get_asset_overrides():
+    """file_ids_v3 中为素材绑定的最新 file_id"""
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT DISTINCT ON (asset_key) asset_key, file_id FROM file_ids_v3 WHERE asset_key IS NOT NULL ORDER BY asset_key, id DESC")
+        rows = dict(cur.fetchall())
+        cur.close()
+    return rows
+
+async def load_asset_registry():
+    """合并 CONFIG 与数据库中的素材，逐个 get_file 探测一次，失效的直接标记为不可用"""
+    try:
+        overrides = await asyncio.to_thread(get_asset_overrides)
+    except Exception as e:
+        logger.warning(f"load asset overrides failed: {e}")
+        overrides = {}
+    probed = {}
+    for key in ASSET_KEYS:
+        fid = overrides.get(key) or CONFIG.get(key)
+        if fid and fid not in probed:
+            try:
+                await bot_app.bot.get_file(fid)
+                probed[fid] = fid
+            except BadRequest as e:
+                logger.warning(f"asset {key} unusable: {e}")
+                probed[fid] = None
+            except Exception:
+                probed[fid] = fid  # 网络问题不判死，发送失败时再标记
+        _assets[key] = probed.get(fid) if fid else None
+
+ASSET_INVALID_ERRORS = ("wrong file identifier", "wrong remote file", "file reference", "wrong type of the web page content", "failed to get http url content")
+
+async def reply_with_asset(query, key, text, reply_markup=None, replace=False):
+    """带素材图回复；replace=True 时发图后删掉原消息，无图时原地编辑"""
+    fid = get_file_id(key)
+    if fid:
+        try:
+            await query.message.reply_photo(fid, caption=text, reply_markup=reply_markup, parse_mode='Markdown')
+        except BadRequest as e:
+            # 只有 file_id 本身失效才停用素材；说明文字解析失败等问题只影响这一次
+            if any(m in str(e).lower() for m in ASSET_INVALID_ERRORS):
+                logger.warning(f"asset {key} rejected: {e}")
+                _assets[key] = None
+            else:
+                logger.warning(f"asset {key} send failed: {e}")
+        except Exception as e:
+            logger.warning(f"asset {key} send failed: {e}")  # 网络/超时：本次退回纯文字
+        else:
+            if replace:
+                try:
+                    await query.delete_message()
+                except:
+                    pass
+            return
+    if replace:
+        await safe_edit(query, text, reply_markup=reply_markup, parse_mode='Markdown')
+    else:
+        await query.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+
 def get_group_link():
     return CONFIG.get("GROUP_LINK", "https://t.me/+495j5rWmApsxYzg9")
 
+# --- 运营统计 (按小时汇总；计数先在内存累积，定时批量写回，不让各写事务争同一行) ---
+# 调用方在自己的事务提交成功后再 bump_stat，回滚的操作不计数
+_active_today = {"day": None, "ids": set()}
+_stats_pending = {}  # (bucket, metric, dim) -> 待写回的增量
+_stats_lock = threading.Lock()
+
+def stat_bucket():
+    return datetime.now(tz_bj).replace(minute=0, second=0, microsecond=0, tzinfo=None)
+
+def bump_stat(metric, dim="", n=1):
+    key = (stat_bucket(), metric, str(dim))
+    with _stats_lock:
+        _stats_pending[key] = _stats_pending.get(key, 0) + n
+
+def flush_stats():
+    """把累积的计数写回 stats_hourly_v8，失败时并回内存下次再试"""
+    with _stats_lock:
+        batch = dict(_stats_pending)
+        _stats_pending.clear()
+    if not batch:
+        return 0
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            # 按主键排序写入，多进程同时写回时加锁顺序一致
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO stats_hourly_v8 (bucket, metric, dim, value) VALUES %s
+                ON CONFLICT (bucket, metric, dim) DO UPDATE SET value = stats_hourly_v8.value + EXCLUDED.value
+            """, [k + (v,) for k, v in sorted(batch.items())])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            with _stats_lock:
+                for k, v in batch.items():
+                    _stats_pending[k] = _stats_pending.get(k, 0) + v
+            raise
+        finally:
+            cur.close()
+    return len(batch)
+
+def is_active_today(user_id):
+    return _active_today["day"] == bj_today() and user_id in _active_today["ids"]
+
+def mark_active(cur, user_id):
+    """当日首次活跃才写库：返回 None (今天已记过) 或本次是否新插入；提交后交给 commit_active"""
+    if is_active_today(user_id):
+        return None
+    cur.execute("INSERT INTO stats_active_v8 (day, user_id) VALUES (%s, %s) ON CONFLICT DO NOTHING RETURNING user_id", (bj_today(), user_id))
+    return cur.fetchone() is not None
+
+def commit_active(user_id, first):
+    """事务提交后才记入内存集合；提交失败的下次仍会重新写库"""
+    if first is None:
+        return
+    today = bj_today()
+    if _active_today["day"] != today:
+        _active_today["day"], _active_today["ids"] = today, set()
+    _active_today["ids"].add(user_id)
+    if first:
+        bump_stat('active')
+
+def get_stats_totals(since):
+    with get_read_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT metric, SUM(value) FROM stats_hourly_v8 WHERE bucket >= %s GROUP BY metric", (since,))
+        totals = dict(cur.fetchall())
+        cur.execute("""
+            SELECT p.name, s.dim, SUM(s.value) AS n FROM stats_hourly_v8 s
+            LEFT JOIN products_v5 p ON p.id::text = s.dim
+            WHERE s.metric = 'purchase' AND s.bucket >= %s GROUP BY 1, 2 ORDER BY n DESC LIMIT 5
+        """, (since,))
+        top = cur.fetchall()
+        cur.close()
+    return totals, top
+
+def get_stats_series(since):
+    with get_read_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT bucket, metric, dim, value FROM stats_hourly_v8 WHERE bucket >= %s ORDER BY bucket", (since,))
+        rs = cur.fetchall()
+        cur.close()
+    return rs
+
+# --- 热点用户状态 (有界 LRU，写路径提交后同步更新) ---
+USER_STATE_FIELDS = ("points", "last_checkin_date", "checkin_count", "vip_expire", "daily_free_count", "last_free_date", "verify_done", "verify_unlock_date")
+NO_COOLDOWN = (0, None, False)
+
+class UserState:
+    """users_v3 的一行加上各流程冷却状态，固定槽位，不带 __dict__"""
+    __slots__ = USER_STATE_FIELDS + ("cooldowns", "expires")
+
+    def row(self):
+        return tuple(getattr(self, f) for f in USER_STATE_FIELDS)
+
+_user_states = OrderedDict()  # user_id -> UserState，按最近使用排序
+_user_loading = {}  # user_id -> 载入令牌，载入期间发生写入则作废
+_user_lock = threading.Lock()
+
+def _load_user_state(user_id):
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT {', '.join(USER_STATE_FIELDS)} FROM users_v3 WHERE user_id=%s", (user_id,))
+        row = cur.fetchone()
+        cur.execute("SELECT flow, fails, lock_until, done FROM user_cooldowns_v8 WHERE user_id=%s", (user_id,))
+        cooldowns = {r[0]: tuple(r[1:]) for r in cur.fetchall()}
+        cur.close()
+    return row, cooldowns
+
+def get_user_state(user_id):
+    """命中直接返回；未命中从主库载入 (不走只读副本，避免把复制延迟缓存下来)"""
+    now = time.monotonic()
+    with _user_lock:
+        st = _user_states.get(user_id)
+        if st and st.expires > now:
+            _user_states.move_to_end(user_id)
+            return st
+        token = _user_loading[user_id] = object()
+    try:
+        row, cooldowns = _load_user_state(user_id)
+    except Exception:
+        with _user_lock:
+            if _user_loading.get(user_id) is token:
+                del _user_loading[user_id]
+        raise
+    st = UserState()
+    for f, v in zip(USER_STATE_FIELDS, row or (0, None, 0, None, 0, None, False, None)):
+        setattr(st, f, v)
+    st.cooldowns = cooldowns
+    st.expires = time.monotonic() + USER_CACHE_TTL
+    with _user_lock:
+        if _user_loading.get(user_id) is token:
+            del _user_loading[user_id]
+            if row:
+                _user_states[user_id] = st
+                if len(_user_states) > USER_CACHE_SIZE:
+                    _user_states.popitem(last=False)
+    return st
+
+def update_user_state(user_id, **fields):
+    """写事务提交后调用：已缓存则原地更新字段 (字段名同 users_v3 列名)，并作废进行中的载入"""
+    with _user_lock:
+        _user_loading.pop(user_id, None)
+        st = _user_states.get(user_id)
+        if st:
+            for f, v in fields.items():
+                setattr(st, f, v)
+
+def set_user_cooldown(user_id, flow, state):
+    with _user_lock:
+        _user_loading.pop(user_id, None)
+        st = _user_states.get(user_id)
+        if st:
+            st.cooldowns[flow] = state
+
+def drop_user_state(user_id):
+    with _user_lock:
+        _user_loading.pop(user_id, None)
+        _user_states.pop(user_id, None)
+
+register_invalidation('user', lambda arg: drop_user_state(int(arg)))
+
+# --- 已注册用户集合 (启动时预热，命中且用户名未变则跳过 upsert) ---
+# ids: users_v3 与 user_ads_v3 都有行的用户，升序 int64 数组 (每人 8 字节)；new: 启动后新注册的，满 KNOWN_USERS_MERGE_AT 个并入 ids
+_known_users = {"ids": array('q'), "new": set()}
+_known_merge_lock = threading.Lock()
+_known_names = OrderedDict()  # user_id -> 最近确认过的用户名 (有界 LRU)
+
+def warm_known_users():
+    with get_read_connection() as conn:
+        cur = conn.cursor(name="known_users")
+        cur.itersize = 50000
+        cur.execute("SELECT u.user_id FROM users_v3 u JOIN user_ads_v3 a USING (user_id) ORDER BY u.user_id")
+        ids = array('q')
+        for (uid,) in cur:
+            ids.append(uid)
+        cur.close()
+        conn.commit()
+    _known_users["ids"] = ids
+    return len(ids)
+
+def is_known_user(user_id):
+    ids = _known_users["ids"]
+    i = bisect.bisect_left(ids, user_id)
+    return (i < len(ids) and ids[i] == user_id) or user_id in _known_users["new"]
+
+def _add_known_user(user_id):
+    _known_users["new"].add(user_id)
+    if len(_known_users["new"]) >= KNOWN_USERS_MERGE_AT and _known_merge_lock.acquire(blocking=False):
+        try:
+            merge_known_users()
+        finally:
+            _known_merge_lock.release()
+
+def merge_known_users():
+    """把 new 归并进有序数组：先换数组再删 new，查询期间每个 id 总在其中一处"""
+    batch = sorted(_known_users["new"])
+    if not batch:
+        return 0
+    _known_users["ids"] = array('q', heapq.merge(_known_users["ids"], batch))
+    _known_users["new"].difference_update(batch)
+    return len(batch)
+
+def _remember_username(user_id, username):
+    with _user_lock:
+        _known_names[user_id] = username
+        _known_names.move_to_end(user_id)
+        if len(_known_names) > USER_CACHE_SIZE:
+            _known_names.popitem(last=False)
+
+register_prepared("user_upsert", "INSERT INTO users_v3 (user_id, username) VALUES (%s, %s) ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username WHERE EXCLUDED.username IS NOT NULL AND users_v3.username IS DISTINCT FROM EXCLUDED.username RETURNING (xmax = 0)")
+register_prepared("user_ads_insert", "INSERT INTO user_ads_v3 (user_id, daily_watch_count) VALUES (%s, 0) ON CONFLICT (user_id) DO NOTHING")
+
 def ensure_user_exists(user_id, username=None):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO users_v3 (user_id, username) VALUES (%s, %s) ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username", (user_id, username))
-    cur.execute("INSERT INTO user_ads_v3 (user_id, daily_watch_count) VALUES (%s, 0) ON CONFLICT (user_id) DO NOTHING", (user_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    """已知用户、用户名未变且今日已记活跃时不访问数据库"""
+    known = is_known_user(user_id)
+    if known and (username is None or _known_names.get(user_id) == username) and is_active_today(user_id):
+        return
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        if not known or username is not None:
+            # 用户名没变时 ON CONFLICT 的 WHERE 不成立，不产生新行版本，也不返回行
+            run_prepared(cur, "user_upsert", (user_id, username))
+            row = cur.fetchone()
+            created = bool(row and row[0])
+        else:
+            created = False
+        if not known:
+            run_prepared(cur, "user_ads_insert", (user_id,))
+        first = mark_active(cur, user_id)
+        conn.commit()
+        if created:
+            note_write(user_id)
+            bump_stat('new_user')
+        cur.close()
+    commit_active(user_id, first)
+    if not known:
+        _add_known_user(user_id)
+    if username is not None:
+        _remember_username(user_id, username)
 
 # --- 积分 ---
+register_prepared("points_update", "UPDATE users_v3 SET points = points + %s WHERE user_id = %s RETURNING points")
+register_prepared("point_log_insert", "INSERT INTO point_logs_v5 (user_id, change_amount, reason) VALUES (%s, %s, %s)")
+
 def update_points(user_id, amount, reason):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE users_v3 SET points = points + %s WHERE user_id = %s RETURNING points", (amount, user_id))
-    new_total = cur.fetchone()[0]
-    cur.execute("INSERT INTO point_logs_v5 (user_id, change_amount, reason) VALUES (%s, %s, %s)", (user_id, amount, reason))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        run_prepared(cur, "points_update", (amount, user_id))
+        new_total = cur.fetchone()[0]
+        run_prepared(cur, "point_log_insert", (user_id, amount, reason))
+        record_point_summary(cur, user_id, amount, reason)
+        notify_invalidation(cur, 'user', user_id)
+        conn.commit()
+        note_write(user_id)
+        cur.close()
+    bump_stat('points_in' if amount >= 0 else 'points_out', n=abs(amount))
+    if reason == "充值":
+        bump_stat('recharge')
+    update_user_state(user_id, points=new_total)
     return new_total
 
+POINT_RECENT_SIZE = 10
+POINT_RECENT_ENTRY = "jsonb_build_array(change_amount, reason, to_char(created_at, 'YYYY-MM-DD HH24:MI:SS'))"
+POINT_RECENT_PREPEND = """
+    UPDATE point_recent_v8 SET entries = (
+        SELECT COALESCE(jsonb_agg(e ORDER BY i), '[]'::jsonb)
+        FROM jsonb_array_elements(jsonb_build_array(jsonb_build_array(%(amt)s::int, %(reason)s::text, to_char(LOCALTIMESTAMP, 'YYYY-MM-DD HH24:MI:SS'))) || entries) WITH ORDINALITY AS t(e, i)
+        WHERE i <= %(keep)s
+    ) WHERE user_id = %(uid)s
+"""
+
+def record_point_summary(cur, user_id, amount, reason):
+    """在调用方事务内增量维护 point_summary_v8 与 point_recent_v8"""
+    cur.execute("""
+        INSERT INTO point_summary_v8 (user_id, category, total, entries) VALUES (%s, split_part(COALESCE(%s, ''), '-', 1), %s, 1)
+        ON CONFLICT (user_id, category) DO UPDATE SET total = point_summary_v8.total + EXCLUDED.total, entries = point_summary_v8.entries + 1
+    """, (user_id, reason, amount))
+    # 已有记录时只在头部插入本次；没有记录才从日志取最近 N 条 (含本次，调用方已先写日志)
+    params = {"uid": user_id, "amt": amount, "reason": reason, "keep": POINT_RECENT_SIZE}
+    cur.execute(POINT_RECENT_PREPEND, params)
+    if cur.rowcount:
+        return
+    cur.execute(f"""
+        INSERT INTO point_recent_v8 (user_id, entries)
+        SELECT %(uid)s, COALESCE(jsonb_agg({POINT_RECENT_ENTRY} ORDER BY created_at DESC, id DESC), '[]'::jsonb) FROM (
+            SELECT id, change_amount, reason, created_at FROM point_logs_v5 WHERE user_id=%(uid)s ORDER BY created_at DESC, id DESC LIMIT %(keep)s
+        ) l
+        ON CONFLICT (user_id) DO NOTHING
+    """, params)
+    if not cur.rowcount:
+        # 并发事务先建了行 (它看不到本次日志)，补上本次
+        cur.execute(POINT_RECENT_PREPEND, params)
+
+def get_point_overview(user_id):
+    """一次查询取回最近记录与分类汇总；最近记录尚未生成时返回 None"""
+    with get_read_connection(user_id) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT (SELECT entries FROM point_recent_v8 WHERE user_id=%(uid)s),
+                   (SELECT jsonb_agg(jsonb_build_array(category, total, entries) ORDER BY total DESC) FROM point_summary_v8 WHERE user_id=%(uid)s)
+        """, {"uid": user_id})
+        recent, summary = cur.fetchone()
+        cur.close()
+    return recent, summary or []
+
+def get_point_category_totals():
+    with get_read_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT category, total, entries, users FROM point_category_totals_mv ORDER BY total DESC")
+        rs = cur.fetchall()
+        cur.close()
+    return rs
+
+def refresh_point_category_totals():
+    with get_db_connection() as conn:
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY point_category_totals_mv")
+        cur.close()
+
 def get_user_data(user_id):
     ensure_user_exists(user_id)
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT points, last_checkin_date, checkin_count, vip_expire, daily_free_count, last_free_date, verify_done, verify_unlock_date FROM users_v3 WHERE user_id=%s", (user_id,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
-    return row
+    return get_user_state(user_id).row()
+
+# --- 积分日志分区维护 ---
+def ensure_point_log_partitions(cur, months_ahead=2):
+    """建好当月及未来几个月的分区，避免写入落到默认分区"""
+    month = bj_today().replace(day=1)
+    for _ in range(months_ahead + 1):
+        nxt = (month + timedelta(days=32)).replace(day=1)
+        cur.execute("SELECT to_regclass(%s)", (f"point_logs_v5_p{month:%Y%m}",))
+        if cur.fetchone()[0] is None:
+            cur.execute("SAVEPOINT point_part")
+            try:
+                cur.execute(f"CREATE TABLE point_logs_v5_p{month:%Y%m} PARTITION OF point_logs_v5 FOR VALUES FROM (%s) TO (%s)", (month, nxt))
+                cur.execute("RELEASE SAVEPOINT point_part")
+            except psycopg2.errors.InvalidObjectDefinition:
+                # 与迁移时挂上的历史分区重叠 (迁移当月)，跳过
+                cur.execute("ROLLBACK TO SAVEPOINT point_part")
+            except psycopg2.errors.CheckViolation:
+                # 默认分区里已有该月数据 (分区没来得及预建)：先把这些行搬进新表再挂上
+                cur.execute("ROLLBACK TO SAVEPOINT point_part")
+                try:
+                    _move_default_rows_to_partition(cur, month, nxt)
+                    cur.execute("RELEASE SAVEPOINT point_part")
+                except psycopg2.Error as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT point_part")
+                    logger.warning(f"point log partition {month:%Y%m} not created: {e}")
+        month = nxt
+
+def _move_default_rows_to_partition(cur, month, nxt):
+    name = f"point_logs_v5_p{month:%Y%m}"
+    cur.execute(f"CREATE TABLE {name} (LIKE point_logs_v5 INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    cur.execute(f"""
+        WITH moved AS (DELETE FROM point_logs_v5_default WHERE created_at >= %s AND created_at < %s RETURNING *)
+        INSERT INTO {name} SELECT * FROM moved
+    """, (month, nxt))
+    moved = cur.rowcount
+    cur.execute(f"ALTER TABLE point_logs_v5 ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", (month, nxt))
+    logger.info(f"moved {moved} rows from point_logs_v5_default into {name}")
+
+def archive_point_log_partitions(cur):
+    """上界早于保留期的分区整体 DETACH 并移入归档 schema，不做逐行删除"""
+    if POINT_LOG_RETENTION_MONTHS <= 0:
+        return []
+    cutoff = bj_today().replace(day=1)
+    for _ in range(POINT_LOG_RETENTION_MONTHS):
+        cutoff = (cutoff - timedelta(days=1)).replace(day=1)
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'point_logs_v5'::regclass
+    """)
+    archived = []
+    for name, bound in cur.fetchall():
+        m = re.search(r"TO \('([^']+)'\)", bound or "")
+        if not m or datetime.fromisoformat(m.group(1)).date() > cutoff:
+            continue
+        cur.execute(f"CREATE SCHEMA IF NOT EXISTS {POINT_LOG_ARCHIVE_SCHEMA}")
+        # DETACH 要对父表加 ACCESS EXCLUSIVE 锁 (有默认分区时不能用 DETACH ... CONCURRENTLY)，
+        # 限定等锁时间：拿不到就放弃本次，避免长事务期间把积分写入全部排在它后面
+        cur.execute("SET LOCAL lock_timeout = '5s'")
+        cur.execute(f"ALTER TABLE point_logs_v5 DETACH PARTITION {name}")
+        cur.execute(f"ALTER TABLE {name} SET SCHEMA {POINT_LOG_ARCHIVE_SCHEMA}")
+        archived.append(name)
+    return archived
+
+def maintain_point_log_partitions():
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        ensure_point_log_partitions(cur)
+        conn.commit()  # 预建分区单独提交，归档等锁超时失败不影响它
+        archived = archive_point_log_partitions(cur)
+        conn.commit()
+        cur.close()
+    return archived
 
 def get_point_logs(user_id, limit=5):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT change_amount, reason, created_at FROM point_logs_v5 WHERE user_id = %s ORDER BY id DESC LIMIT %s", (user_id, limit))
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+    with get_read_connection(user_id) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT change_amount, reason, created_at FROM point_logs_v5 WHERE user_id = %s ORDER BY created_at DESC, id DESC LIMIT %s", (user_id, limit))
+        rows = cur.fetchall()
+        cur.close()
     return rows
 
 def process_checkin(user_id):
     ensure_user_exists(user_id)
-    conn = get_db_connection()
-    cur = conn.cursor()
-    today = datetime.now(tz_bj).date()
-    cur.execute("SELECT last_checkin_date, checkin_count FROM users_v3 WHERE user_id=%s", (user_id,))
-    row = cur.fetchone()
-    if row[0] == today:
-        cur.close(); conn.close()
+    today = bj_today()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            WITH c AS (
+                UPDATE users_v3 SET
+                    points = points + CASE WHEN checkin_count = 0 THEN 10 ELSE %(pts)s END,
+                    last_checkin_date = %(today)s, checkin_count = checkin_count + 1
+                WHERE user_id = %(uid)s AND last_checkin_date IS DISTINCT FROM %(today)s
+                RETURNING user_id, points, checkin_count, CASE WHEN checkin_count = 1 THEN 10 ELSE %(pts)s END AS added
+            ), l AS (
+                INSERT INTO point_logs_v5 (user_id, change_amount, reason) SELECT user_id, added, '每日签到' FROM c
+            )
+            SELECT added, points, checkin_count FROM c
+        """, {"uid": user_id, "today": today, "pts": random.randint(3, 8)})
+        row = cur.fetchone()
+        if row:
+            record_point_summary(cur, user_id, row[0], '每日签到')
+            notify_invalidation(cur, 'user', user_id)
+        conn.commit()
+        note_write(user_id)
+        cur.close()
+    if row:
+        bump_stat('checkin')
+        bump_stat('points_in', n=row[0])
+        update_user_state(user_id, points=row[1], last_checkin_date=today, checkin_count=row[2])
+    if not row:
         return {"status": "already_checked"}
-    pts = 10 if row[1] == 0 else random.randint(3, 8)
-    cur.execute("UPDATE users_v3 SET points=points+%s, last_checkin_date=%s, checkin_count=checkin_count+1 WHERE user_id=%s RETURNING points", (pts, today, user_id))
-    tot = cur.fetchone()[0]
-    cur.execute("INSERT INTO point_logs_v5 (user_id, change_amount, reason) VALUES (%s, %s, '每日签到')", (user_id, pts))
-    conn.commit()
-    cur.close()
-    conn.close()
-    return {"status": "success", "added": pts, "total": tot}
+    return {"status": "success", "added": row[0], "total": row[1]}
 
 # --- 验证/锁 ---
-def check_lock(user_id, type_prefix):
-    ensure_user_exists(user_id)
-    conn = get_db_connection()
-    cur = conn.cursor()
-    fields = f"{type_prefix}_fails, {type_prefix}_lock"
-    if type_prefix == 'verify': fields += ", verify_done"
-    cur.execute(f"SELECT {fields} FROM users_v3 WHERE user_id = %s", (user_id,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
-    if row:
-        done = row[2] if len(row) > 2 else False
-        return row[0], row[1], done
-    return 0, None, False
+# flow: (最大失败次数, 锁定分钟, 成功后标记完成)
+COOLDOWN_FLOWS = {
+    'verify': (2, 3 * 60, True),
+    'wx': (2, 3 * 60, False),
+    'ali': (2, 3 * 60, False),
+    'vip_buy': (2, 10, False),
+}
 
-def update_fail(user_id, type_prefix, current_fails, lock_minutes):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    new_fails = current_fails + 1
-    if new_fails >= 2:
-        lock_until = datetime.now() + timedelta(minutes=lock_minutes)
-        cur.execute(f"UPDATE users_v3 SET {type_prefix}_fails = %s, {type_prefix}_lock = %s WHERE user_id = %s", (new_fails, lock_until, user_id))
-    else:
-        cur.execute(f"UPDATE users_v3 SET {type_prefix}_fails = %s WHERE user_id = %s", (new_fails, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
-    return new_fails
+def check_lock(user_id, flow):
+    return get_user_state(user_id).cooldowns.get(flow, NO_COOLDOWN)
+
+def update_fail(user_id, flow):
+    """失败次数 +1，达到上限时同一条语句内加锁，返回新的失败次数"""
+    max_fails, lock_minutes, _ = COOLDOWN_FLOWS[flow]
+    lock_until = datetime.now() + timedelta(minutes=lock_minutes)
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO user_cooldowns_v8 (user_id, flow, fails, lock_until)
+            VALUES (%(uid)s, %(flow)s, 1, CASE WHEN 1 >= %(max)s THEN %(until)s::timestamp END)
+            ON CONFLICT (user_id, flow) DO UPDATE SET
+                fails = user_cooldowns_v8.fails + 1,
+                lock_until = CASE WHEN user_cooldowns_v8.fails + 1 >= %(max)s THEN %(until)s::timestamp ELSE user_cooldowns_v8.lock_until END
+            RETURNING fails, lock_until, done
+        """, {"uid": user_id, "flow": flow, "max": max_fails, "until": lock_until})
+        state = cur.fetchone()
+        notify_invalidation(cur, 'user', user_id)
+        conn.commit()
+        cur.close()
+    set_user_cooldown(user_id, flow, tuple(state))
+    return state[0]
 
-def mark_success(user_id, type_prefix):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    sql = f"UPDATE users_v3 SET {type_prefix}_fails=0, {type_prefix}_lock=NULL"
-    if type_prefix == 'verify': sql += ", verify_done=TRUE"
-    cur.execute(sql + " WHERE user_id=%s", (user_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+def _reset_cooldown(cur, user_id, flow):
+    cur.execute("""
+        INSERT INTO user_cooldowns_v8 (user_id, flow, done) VALUES (%s, %s, %s)
+        ON CONFLICT (user_id, flow) DO UPDATE SET fails=0, lock_until=NULL, done = user_cooldowns_v8.done OR EXCLUDED.done
+        RETURNING fails, lock_until, done
+    """, (user_id, flow, COOLDOWN_FLOWS[flow][2]))
+    return tuple(cur.fetchone())
+
+def mark_success(user_id, flow):
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        state = _reset_cooldown(cur, user_id, flow)
+        notify_invalidation(cur, 'user', user_id)
+        conn.commit()
+        cur.close()
+    set_user_cooldown(user_id, flow, state)
 
 # --- VIP ---
 def activate_vip(user_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    expire = datetime(2099, 1, 1)
-    cur.execute("UPDATE users_v3 SET vip_expire=%s, vip_buy_fails=0, vip_buy_lock=NULL WHERE user_id=%s", (expire, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        expire = datetime(2099, 1, 1)
+        cur.execute("UPDATE users_v3 SET vip_expire=%s WHERE user_id=%s", (expire, user_id))
+        state = _reset_cooldown(cur, user_id, 'vip_buy')
+        notify_invalidation(cur, 'user', user_id)
+        conn.commit()
+        note_write(user_id)
+        cur.close()
+    bump_stat('vip')
+    set_user_cooldown(user_id, 'vip_buy', state)
+    update_user_state(user_id, vip_expire=expire)
 
 def is_vip(user_id):
     ensure_user_exists(user_id)
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT vip_expire FROM users_v3 WHERE user_id=%s", (user_id,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
-    if row and row[0] and row[0] > datetime.now(): return True, row[0]
+    expire = get_user_state(user_id).vip_expire
+    if expire and expire > datetime.now(): return True, expire
     return False, None
 
 # --- 七星密钥 V7 ---
+# 行结构: id, key_1, link_1 ... key_7, link_7, epoch, updated_at
+KEYS_V7_COLUMNS = "id, " + ", ".join(f"key_{i}, link_{i}" for i in range(1, 8)) + ", epoch, updated_at"
+KEYS_V7_EPOCH = 15
+_keys_cache = {"row": None, "until": 0, "gen": 0}
+
+def drop_keys_cache(arg=""):
+    _keys_cache["row"] = None
+    _keys_cache["gen"] += 1
+
+register_invalidation('keys', drop_keys_cache)
+
+register_prepared("key_row", f"SELECT {KEYS_V7_COLUMNS} FROM system_keys_v7 WHERE id=1")
+register_prepared("key_use", "INSERT INTO user_used_keys_v7 (user_id, key_index, epoch) VALUES (%s, %s, %s) ON CONFLICT (user_id, key_index, epoch) DO NOTHING RETURNING id")
+
 def refresh_system_keys_v7():
     keys = [generate_random_key() for _ in range(7)]
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE system_keys_v7 SET key_1=%s, link_1=NULL, key_2=%s, link_2=NULL, key_3=%s, link_3=NULL, key_4=%s, link_4=NULL, key_5=%s, link_5=NULL, key_6=%s, link_6=NULL, key_7=%s, link_7=NULL, updated_at=CURRENT_TIMESTAMP WHERE id=1", tuple(keys))
-    cur.execute("TRUNCATE TABLE user_used_keys_v7")
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        # 只推进 epoch，旧 epoch 的使用记录由后台分批清理，不锁表
+        cur.execute("UPDATE system_keys_v7 SET key_1=%s, link_1=NULL, key_2=%s, link_2=NULL, key_3=%s, link_3=NULL, key_4=%s, link_4=NULL, key_5=%s, link_5=NULL, key_6=%s, link_6=NULL, key_7=%s, link_7=NULL, epoch=epoch+1, updated_at=CURRENT_TIMESTAMP WHERE id=1", tuple(keys))
+        notify_invalidation(cur, 'keys')
+        conn.commit()
+        cur.close()
+    drop_keys_cache()
     return keys
 
 def get_system_keys_v7():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM system_keys_v7 WHERE id=1")
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
+    row = _keys_cache["row"]
+    if row and time.monotonic() < _keys_cache["until"]:
+        return row
+    return single_flight("system_keys_v7", _load_system_keys_v7)
+
+def _load_system_keys_v7():
+    gen = _keys_cache["gen"]
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        run_prepared(cur, "key_row")
+        row = cur.fetchone()
+        cur.close()
     
     # 修复：如果为空或数据不完整，立刻刷新
     if not row or not row[1]:
         refresh_system_keys_v7()
-        return get_system_keys_v7() # 递归调用一次获取新数据
+        return _load_system_keys_v7() # 递归调用一次获取新数据
+    if _keys_cache["gen"] == gen:
+        _keys_cache["row"], _keys_cache["until"] = row, time.monotonic() + KEYS_CACHE_TTL
     return row
 
 def update_key_link_v7(index, link):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(f"UPDATE system_keys_v7 SET link_{index}=%s WHERE id=1", (link,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"UPDATE system_keys_v7 SET link_{index}=%s WHERE id=1", (link,))
+        notify_invalidation(cur, 'keys')
+        conn.commit()
+        cur.close()
+    drop_keys_cache()
 
 def check_key_valid(user_id, input_key):
     row = get_system_keys_v7()
@@ -323,299 +1289,1197 @@ def check_key_valid(user_id, input_key):
             found_idx = i
             break
     if found_idx == -1: return False, "invalid"
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM user_used_keys_v7 WHERE user_id=%s AND key_index=%s", (user_id, found_idx))
-    if cur.fetchone(): cur.close(); conn.close(); return False, "used"
-    cur.execute("INSERT INTO user_used_keys_v7 (user_id, key_index) VALUES (%s, %s)", (user_id, found_idx))
-    cur.execute("UPDATE users_v3 SET verify_unlock_date=%s WHERE user_id=%s", (datetime.now(tz_bj).date(), user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        run_prepared(cur, "key_use", (user_id, found_idx, row[KEYS_V7_EPOCH]))
+        if not cur.fetchone(): conn.rollback(); cur.close(); return False, "used"
+        today = bj_today()
+        cur.execute("UPDATE users_v3 SET verify_unlock_date=%s WHERE user_id=%s", (today, user_id))
+        notify_invalidation(cur, 'user', user_id)
+        conn.commit()
+        cur.close()
+    update_user_state(user_id, verify_unlock_date=today)
     return True, "success"
 
+def purge_old_key_epochs_batch(batch_size=1000):
+    """删除一批旧 epoch 的已用密钥记录，返回删除行数"""
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            DELETE FROM user_used_keys_v7 WHERE id IN (
+                SELECT id FROM user_used_keys_v7
+                WHERE epoch < (SELECT epoch FROM system_keys_v7 WHERE id=1)
+                ORDER BY epoch, id LIMIT %s
+            )
+        """, (batch_size,))
+        n = cur.rowcount
+        conn.commit()
+        cur.close()
+    return n
+
 def is_exchange_unlocked(user_id):
     is_v, _ = is_vip(user_id)
     if is_v: return True
     ensure_user_exists(user_id)
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT verify_unlock_date FROM users_v3 WHERE user_id=%s", (user_id,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
-    return row and row[0] == datetime.now(tz_bj).date()
+    return get_user_state(user_id).verify_unlock_date == bj_today()
 
 # --- 商品 & 转发 ---
 def get_products_list(limit, offset):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, name, price FROM products_v5 ORDER BY id DESC LIMIT %s OFFSET %s", (limit, offset))
-    rs = cur.fetchall()
-    cur.execute("SELECT COUNT(*) FROM products_v5")
-    t = cur.fetchone()[0]
-    cur.close()
-    conn.close()
+    if offset == 0:
+        return cached_lookup('products', ('page', limit), _query_products_list, limit, offset)
+    return _query_products_list(limit, offset)
+
+def _query_products_list(limit, offset):
+    with get_read_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, name, price FROM products_v5 ORDER BY id DESC LIMIT %s OFFSET %s", (limit, offset))
+        rs = cur.fetchall()
+        cur.execute("SELECT COUNT(*) FROM products_v5")
+        t = cur.fetchone()[0]
+        cur.close()
     return rs, t
 
 def get_product_details(pid):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, name, price, content_text, content_file_id, content_type FROM products_v5 WHERE id=%s", (pid,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
+    return cached_lookup('products', ('detail', pid), _query_product_details, pid)
+
+def _query_product_details(pid):
+    with get_read_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, name, price, content_text, content_file_id, content_type FROM products_v5 WHERE id=%s", (pid,))
+        row = cur.fetchone()
+        cur.close()
     return row
 
+register_prepared("purchase_check", "SELECT id FROM user_purchases_v5 WHERE user_id=%s AND product_id=%s")
+
 def check_purchase(uid, pid):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM user_purchases_v5 WHERE user_id=%s AND product_id=%s", (uid, pid))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
+    with get_read_connection(uid) as conn:
+        cur = conn.cursor()
+        run_prepared(cur, "purchase_check", (uid, pid))
+        row = cur.fetchone()
+        cur.close()
     return True if row else False
 
 def record_purchase(uid, pid):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO user_purchases_v5 (user_id, product_id) VALUES (%s, %s) ON CONFLICT DO NOTHING", (uid, pid))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO user_purchases_v5 (user_id, product_id) VALUES (%s, %s) ON CONFLICT DO NOTHING RETURNING id", (uid, pid))
+        bought = cur.fetchone() is not None
+        conn.commit()
+        note_write(uid)
+        cur.close()
+    if bought:
+        bump_stat('purchase', pid)
 
 def add_product(name, price, text, fid, ftype):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO products_v5 (name, price, content_text, content_file_id, content_type) VALUES (%s, %s, %s, %s, %s)", (name, price, text, fid, ftype))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO products_v5 (name, price, content_text, content_file_id, content_type) VALUES (%s, %s, %s, %s, %s)", (name, price, text, fid, ftype))
+        notify_invalidation(cur, 'shared', 'products')
+        conn.commit()
+        note_write()
+        drop_shared_cache('products')
+        cur.close()
+
+# --- 商品批量导入 ---
+PRODUCT_IMPORT_BATCH = 500
+
+def _text_field(rec, key):
+    """可选文本字段：只接受字符串 (或缺省)，且必须是合法 UTF-8"""
+    v = rec.get(key)
+    if v is None or v == "":
+        return None
+    if not isinstance(v, str):
+        raise ValueError(f"{key} 必须是字符串: {v!r}")
+    try:
+        v.encode("utf-8")
+    except UnicodeEncodeError:
+        raise ValueError(f"{key} 不是有效的 UTF-8")
+    return v
+
+def _parse_product_row(rec):
+    """校验一行商品数据 (str 为 jsonl 原始行)，返回 INSERT 参数元组，非法时抛 ValueError"""
+    if isinstance(rec, str):
+        rec = json.loads(rec)  # JSONDecodeError 是 ValueError 的子类
+    if not isinstance(rec, dict):
+        raise ValueError("不是对象")
+    name = (_text_field(rec, "name") or "").strip()
+    if not name:
+        raise ValueError("缺少 name")
+    price = rec.get("price")
+    if isinstance(price, bool) or not isinstance(price, (int, str)):
+        raise ValueError(f"price 不是整数: {price!r}")
+    try:
+        price = int(price.strip()) if isinstance(price, str) else price
+    except ValueError:
+        raise ValueError(f"price 不是整数: {price!r}")
+    if price < 0:
+        raise ValueError("price 不能为负")
+    if price > 2**31 - 1:
+        raise ValueError("price 过大")
+    text = _text_field(rec, "content_text")
+    fid = _text_field(rec, "content_file_id")
+    ftype = (_text_field(rec, "content_type") or ("text" if not fid else "")).strip()
+    if ftype not in ("text", "photo", "video"):
+        raise ValueError(f"content_type 无效: {ftype!r}")
+    if ftype != "text" and not fid:
+        raise ValueError(f"{ftype} 缺少 content_file_id")
+    return (name, price, text, fid, ftype)
+
+def _iter_product_records(f, fmt):
+    """逐行产出 (行号, 记录)：csv 与 jsonl 流式读取 (jsonl 产出原始行，解析放到逐行校验里)，json 数组整体解析。
+    非法 UTF-8 字节以 surrogateescape 保留，由逐行校验报错，不中断整个文件"""
+    text = io.TextIOWrapper(f, encoding="utf-8-sig", errors="surrogateescape")
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        for rec in reader:
+            yield reader.line_num, rec
+    elif fmt == "jsonl":
+        for i, line in enumerate(text, 1):
+            if line.strip():
+                yield i, line
+    else:
+        for i, rec in enumerate(json.load(text), 1):
+            yield i, rec
+
+def import_products_file(f, fmt):
+    """解析并在一个事务内分批写入，返回 (导入数, 错误列表)"""
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        imported, errors, batch = 0, [], []
+        sql = "INSERT INTO products_v5 (name, price, content_text, content_file_id, content_type) VALUES %s"
+        try:
+            for line_no, rec in _iter_product_records(f, fmt):
+                try:
+                    batch.append(_parse_product_row(rec))
+                except ValueError as e:
+                    errors.append((line_no, str(e)))
+                    continue
+                if len(batch) >= PRODUCT_IMPORT_BATCH:
+                    psycopg2.extras.execute_values(cur, sql, batch, page_size=PRODUCT_IMPORT_BATCH)
+                    imported += len(batch)
+                    batch = []
+            if batch:
+                psycopg2.extras.execute_values(cur, sql, batch, page_size=PRODUCT_IMPORT_BATCH)
+                imported += len(batch)
+            notify_invalidation(cur, 'shared', 'products')
+            conn.commit()
+            note_write()
+            drop_shared_cache('products')
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+    return imported, errors
 
 def delete_product(pid):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM products_v5 WHERE id=%s", (pid,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM products_v5 WHERE id=%s", (pid,))
+        notify_invalidation(cur, 'shared', 'products')
+        conn.commit()
+        note_write()
+        drop_shared_cache('products')
+        cur.close()
 
 def check_daily_free(user_id):
-    ensure_user_exists(user_id)
-    conn = get_db_connection()
-    cur = conn.cursor()
-    today = datetime.now(tz_bj).date()
-    cur.execute("SELECT daily_free_count, last_free_date FROM users_v3 WHERE user_id=%s", (user_id,))
-    row = cur.fetchone()
-    count = row[0]
-    last_date = row[1]
-    
-    if last_date != today:
-        count = 0
-    
-    has_free = count < 5
-    cur.close()
-    conn.close()
-    return count, has_free
+    st = get_user_state(user_id)
+    count = (st.daily_free_count or 0) if st.last_free_date == bj_today() else 0
+    return count, count < VIP_DAILY_FREE
 
 def use_free_chance(user_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    today = datetime.now(tz_bj).date()
-    cur.execute("SELECT daily_free_count, last_free_date FROM users_v3 WHERE user_id=%s", (user_id,))
-    row = cur.fetchone()
-    count = row[0]
-    if row[1] != today:
-        count = 0
-    
-    cur.execute("UPDATE users_v3 SET daily_free_count=%s, last_free_date=%s WHERE user_id=%s", (count+1, today, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    """占用一次会员免费兑换，额度已满时返回 False"""
+    return consume_daily_quota(user_id, 'free', VIP_DAILY_FREE) is not None
+
+# --- 管理员用户浏览 ---
+USERS_PAGE_SIZE = 20
+
+def get_users_page(after=None, vip_only=False, prefix=None, limit=USERS_PAGE_SIZE):
+    """按积分倒序的键集分页，after 为上一页最后一行的 (points, user_id)"""
+    where, params = [], []
+    if after:
+        where.append("(points, user_id) < (%s, %s)")
+        params += list(after)
+    if vip_only:
+        where.append("vip_expire IS NOT NULL AND vip_expire > %s")
+        params.append(datetime.now())
+    if prefix:
+        where.append("lower(username) LIKE %s")
+        params.append(prefix.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+    sql = "SELECT user_id, username, points, vip_expire FROM users_v3"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY points DESC, user_id DESC LIMIT %s"
+    with get_read_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params + [limit])
+        rs = cur.fetchall()
+        cur.close()
+    return rs
 
-def get_all_users_info(l, o):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id, username, points, vip_expire FROM users_v3 ORDER BY points DESC LIMIT %s OFFSET %s", (l, o))
-    rs = cur.fetchall()
-    cur.execute("SELECT COUNT(*) FROM users_v3")
-    t = cur.fetchone()[0]
-    cur.close()
-    conn.close()
-    return rs, t
+def get_user_brief(uid):
+    with get_read_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT user_id, username, points, vip_expire FROM users_v3 WHERE user_id=%s", (uid,))
+        row = cur.fetchone()
+        cur.close()
+    return row
 
-def save_file_id(fid, fuid):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO file_ids_v3 (file_id, file_unique_id) VALUES (%s, %s)", (fid, fuid))
-    conn.commit()
-    cur.close()
-    conn.close()
+def estimate_users_count():
+    """用 pg_class 统计信息估算总人数，避免 COUNT(*) 全表扫描"""
+    with get_read_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT GREATEST(reltuples, 0)::bigint FROM pg_class WHERE oid = 'users_v3'::regclass")
+        t = cur.fetchone()[0]
+        cur.close()
+    return t
 
-def get_all_files():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, file_id FROM file_ids_v3 ORDER BY id DESC LIMIT 10")
-    rs = cur.fetchall()
-    cur.close()
-    conn.close()
-    return rs
+# --- CSV 导出 (COPY TO STDOUT，流式不落内存) ---
+EXPORT_TABLES = {
+    'users': "SELECT user_id, username, points, checkin_count, last_checkin_date, vip_expire, daily_free_count, last_free_date, verify_unlock_date FROM users_v3",
+    'point_logs': "SELECT id, user_id, change_amount, reason, created_at FROM point_logs_v5",
+    'purchases': "SELECT id, user_id, product_id, purchase_date FROM user_purchases_v5",
+}
 
-def delete_file_by_id(did):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM file_ids_v3 WHERE id=%s", (did,))
-    conn.commit()
-    cur.close()
-    conn.close()
+class _QueueWriter:
+    """COPY 的输出写进有界队列，消费方跟不上时 COPY 线程阻塞等待"""
+    def __init__(self, q, cancelled):
+        self.q = q
+        self.cancelled = cancelled
 
-def add_custom_command(cmd):
-    conn = get_db_connection()
-    cur = conn.cursor()
+    def put(self, item):
+        """带超时重试放入队列；消费方已取消时放弃并返回 False，不会永久阻塞"""
+        while not self.cancelled.is_set():
+            try:
+                self.q.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def write(self, data):
+        if not self.put(data):
+            raise RuntimeError("export cancelled")
+        return len(data)
+
+def copy_table_csv(name, out):
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.copy_expert(f"COPY ({EXPORT_TABLES[name]}) TO STDOUT WITH (FORMAT csv, HEADER)", out, size=65536)
+        finally:
+            cur.close()
+
+async def stream_table_csv(name):
+    """异步生成 CSV 分块；客户端断开时通知 COPY 线程中止"""
+    q = queue.Queue(maxsize=32)
+    cancelled = threading.Event()
+
+    failed = []
+
+    def run():
+        writer = _QueueWriter(q, cancelled)
+        try:
+            copy_table_csv(name, writer)
+        except Exception as e:
+            if not cancelled.is_set():
+                logger.warning(f"export {name} failed: {e}")
+                failed.append(e)
+        finally:
+            writer.put(None)
+
+    producer = asyncio.create_task(asyncio.to_thread(run))
     try:
-        cur.execute("INSERT INTO custom_commands_v4 (command_name) VALUES (%s) RETURNING id", (cmd,))
-        cid = cur.fetchone()[0]
+        while True:
+            # 带超时取，消费方被取消时不会留下永久阻塞在 q.get 上的线程
+            try:
+                chunk = await asyncio.to_thread(q.get, True, 1)
+            except queue.Empty:
+                if producer.done() and q.empty():
+                    raise RuntimeError(f"export {name} stopped without finishing")
+                continue
+            if chunk is None:
+                break
+            yield chunk
+        if failed:
+            # 中途失败不能当作完整文件结束：抛出让服务端中断响应，客户端拿到的是不完整传输
+            raise RuntimeError(f"export {name} failed: {failed[0]}")
+    finally:
+        cancelled.set()
+        await producer
+
+def export_table_gzip(name):
+    """导出到磁盘临时文件 (gzip)，供 Telegram 发送文档"""
+    f = tempfile.TemporaryFile()
+    with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+        copy_table_csv(name, gz)
+    f.seek(0)
+    return f
+
+def save_file_id(fid, fuid, asset_key=None):
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO file_ids_v3 (file_id, file_unique_id, asset_key) VALUES (%s, %s, %s)", (fid, fuid, asset_key))
         conn.commit()
         cur.close()
-        conn.close()
-        return cid
-    except:
-        conn.rollback()
+
+def get_all_files():
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, file_id FROM file_ids_v3 ORDER BY id DESC LIMIT 10")
+        rs = cur.fetchall()
         cur.close()
-        conn.close()
-        return None
+    return rs
+
+def delete_file_by_id(did):
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM file_ids_v3 WHERE id=%s", (did,))
+        conn.commit()
+        cur.close()
+
+def add_custom_command(cmd):
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("INSERT INTO custom_commands_v4 (command_name) VALUES (%s) RETURNING id", (cmd,))
+            cid = cur.fetchone()[0]
+            notify_invalidation(cur, 'shared', 'commands')
+            conn.commit()
+            note_write()
+            drop_shared_cache('commands')
+            cur.close()
+            return cid
+        except:
+            conn.rollback()
+            cur.close()
+            return None
 
 def add_command_content(cid, fid, ftype, cap, txt):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO command_contents_v4 (command_id,file_id,file_type,caption,message_text) VALUES (%s,%s,%s,%s,%s)", (cid, fid, ftype, cap, txt))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO command_contents_v4 (command_id,file_id,file_type,caption,message_text) VALUES (%s,%s,%s,%s,%s)", (cid, fid, ftype, cap, txt))
+        notify_invalidation(cur, 'shared', 'commands')
+        conn.commit()
+        note_write()
+        drop_shared_cache('commands')
+        cur.close()
 
 def get_commands_list(limit, offset):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, command_name FROM custom_commands_v4 ORDER BY id DESC LIMIT %s OFFSET %s", (limit, offset))
-    rs = cur.fetchall()
-    cur.execute("SELECT COUNT(*) FROM custom_commands_v4")
-    t = cur.fetchone()[0]
-    cur.close()
-    conn.close()
+    with get_read_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, command_name FROM custom_commands_v4 ORDER BY id DESC LIMIT %s OFFSET %s", (limit, offset))
+        rs = cur.fetchall()
+        cur.execute("SELECT COUNT(*) FROM custom_commands_v4")
+        t = cur.fetchone()[0]
+        cur.close()
     return rs, t
 
 def delete_command_by_id(cid):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM custom_commands_v4 WHERE id=%s", (cid,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM custom_commands_v4 WHERE id=%s", (cid,))
+        notify_invalidation(cur, 'shared', 'commands')
+        conn.commit()
+        note_write()
+        drop_shared_cache('commands')
+        cur.close()
+
+register_prepared("command_content", "SELECT c.id, c.file_id, c.file_type, c.caption, c.message_text FROM command_contents_v4 c JOIN custom_commands_v4 cmd ON c.command_id=cmd.id WHERE cmd.command_name=%s ORDER BY c.sort_order")
 
 def get_command_content(cmd):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT c.id, c.file_id, c.file_type, c.caption, c.message_text FROM command_contents_v4 c JOIN custom_commands_v4 cmd ON c.command_id=cmd.id WHERE cmd.command_name=%s ORDER BY c.sort_order", (cmd,))
-    rs = cur.fetchall()
-    cur.close()
-    conn.close()
+    """任意聊天文本都会走到这里：先查命令名集合，不是命令的直接返回，不占缓存"""
+    if cmd not in cached_lookup('commands', None, _query_command_names):
+        return []
+    return cached_lookup('commands', cmd, _query_command_content, cmd)
+
+def _query_command_names():
+    with get_read_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT command_name FROM custom_commands_v4")
+        names = frozenset(r[0] for r in cur.fetchall())
+        cur.close()
+    return names
+
+def _query_command_content(cmd):
+    with get_read_connection() as conn:
+        cur = conn.cursor()
+        run_prepared(cur, "command_content", (cmd,))
+        rs = cur.fetchall()
+        cur.close()
     return rs
 
-def reset_admin_stats(aid):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE user_ads_v3 SET daily_watch_count=0 WHERE user_id=%s", (aid,))
-    cur.execute("DELETE FROM user_key_claims_v3 WHERE user_id=%s", (aid,))
-    cur.execute("DELETE FROM user_purchases_v5 WHERE user_id=%s", (aid,))
-    cur.execute("DELETE FROM user_used_keys_v7 WHERE user_id=%s", (aid,))
-    cur.execute("""
-        UPDATE users_v3 SET 
-        verify_fails=0, verify_lock=NULL, verify_done=FALSE,
-        wx_fails=0, wx_lock=NULL, wx_done=FALSE,
-        ali_fails=0, ali_lock=NULL, ali_done=FALSE,
-        vip_expire=NULL, daily_free_count=0, vip_buy_fails=0, vip_buy_lock=NULL, verify_unlock_date=NULL
-        WHERE user_id=%s
-    """, (aid,))
-    conn.commit()
-    cur.close()
-    conn.close()
+def reset_admin_stats(aid):
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE user_ads_v3 SET daily_watch_count=0 WHERE user_id=%s", (aid,))
+        cur.execute("DELETE FROM user_key_claims_v3 WHERE user_id=%s", (aid,))
+        cur.execute("DELETE FROM user_purchases_v5 WHERE user_id=%s", (aid,))
+        cur.execute("DELETE FROM user_used_keys_v7 WHERE user_id=%s", (aid,))
+        cur.execute("DELETE FROM user_cooldowns_v8 WHERE user_id=%s", (aid,))
+        notify_invalidation(cur, 'user', aid)
+        cur.execute("UPDATE users_v3 SET vip_expire=NULL, daily_free_count=0, verify_unlock_date=NULL WHERE user_id=%s", (aid,))
+        conn.commit()
+        cur.close()
+    drop_user_state(aid)
+
+def get_ad_status(uid):
+    """今日已看广告次数 (只读；计数由广告奖励流程写入，不走 DAILY_QUOTAS)"""
+    with get_read_connection(uid) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT CASE WHEN last_watch_date = %s THEN daily_watch_count ELSE 0 END FROM user_ads_v3 WHERE user_id=%s", (bj_today(), uid))
+        row = cur.fetchone()
+        cur.close()
+    return row[0] if row else 0
+
+# --- 密钥点击计数 (内存写回) ---
+_click_counters = {}  # (user_id, session_date) -> click_count
+_click_dirty = set()
+_click_lock = threading.Lock()
+
+def get_user_click_status(uid):
+    s = get_session_date()
+    with _click_lock:
+        if (uid, s) in _click_counters:
+            return _click_counters[(uid, s)]
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT click_count, session_date FROM user_key_clicks_v3 WHERE user_id=%s", (uid,))
+        row = cur.fetchone()
+        cur.close()
+    count = row[0] if row and row[1] == s else 0
+    with _click_lock:
+        return _click_counters.setdefault((uid, s), count)
+
+def increment_user_click(uid):
+    s = get_session_date()
+    get_user_click_status(uid)
+    with _click_lock:
+        _click_counters[(uid, s)] = _click_counters.get((uid, s), 0) + 1
+        _click_dirty.add((uid, s))
+        return _click_counters[(uid, s)]
+
+def flush_click_counters():
+    """把内存中的点击计数批量写回数据库，同时清理过期会话"""
+    current = get_session_date()
+    with _click_lock:
+        batch = {}
+        for uid, s in _click_dirty:
+            if uid not in batch or batch[uid][2] < s:
+                batch[uid] = (uid, _click_counters[(uid, s)], s)
+        _click_dirty.clear()
+        for k in [k for k in _click_counters if k[1] != current]:
+            del _click_counters[k]
+    if not batch:
+        return 0
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO user_key_clicks_v3 (user_id, click_count, session_date) VALUES %s
+                ON CONFLICT (user_id) DO UPDATE SET click_count=EXCLUDED.click_count, session_date=EXCLUDED.session_date
+                WHERE user_key_clicks_v3.session_date IS NULL OR user_key_clicks_v3.session_date <= EXCLUDED.session_date
+            """, list(batch.values()))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            with _click_lock:
+                _click_dirty.update((uid, s) for uid, _, s in batch.values() if (uid, s) in _click_counters)
+            raise
+        finally:
+            cur.close()
+    return len(batch)
+
+# --- 临时数据清理 ---
+def janitor_rules():
+    """(表, 主键列, 过期条件, 参数)；按主键键集分批删除"""
+    now = datetime.now()
+    return [
+        ("ad_tokens_v3", "token", "created_at < %s", (now - timedelta(hours=AD_TOKEN_TTL_HOURS),)),
+        ("user_key_claims_v3", "id", "claimed_at < %s", (now - timedelta(days=KEY_CLAIM_RETENTION_DAYS),)),
+        # 绑定了素材名的记录要保留
+        ("file_ids_v3", "id", "asset_key IS NULL AND created_at < %s", (now - timedelta(days=FILE_ID_RETENTION_DAYS),)),
+        ("user_key_clicks_v3", "user_id", "session_date < %s", (get_session_date(),)),
+        # 只用于当日活跃去重，小时汇总里已有 active 计数
+        ("stats_active_v8", "day", "day < %s", (bj_today() - timedelta(days=STATS_ACTIVE_RETENTION_DAYS),)),
+    ]
+
+def janitor_delete_batch(table, key, where, params, after=None):
+    """删除 key 不小于 after 的一批过期行，返回 (删除行数, 本批最大 key)。
+    按 ctid 定位删除，key 不必唯一 (如按天)；已删的行不会再被选中，所以键集条件用 >="""
+    cond = f"{key} >= %s AND {where}" if after is not None else where
+    args = ((after,) if after is not None else ()) + tuple(params) + (JANITOR_BATCH,)
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        # 最大主键在库里取，和 ORDER BY 使用同一排序规则
+        cur.execute(f"""
+            WITH doomed AS (SELECT ctid AS tid, {key} AS k FROM {table} WHERE {cond} ORDER BY {key} LIMIT %s),
+            gone AS (DELETE FROM {table} t USING doomed d WHERE t.ctid = d.tid RETURNING d.k)
+            SELECT COUNT(*), MAX(k) FROM gone
+        """, args)
+        n, last = cur.fetchone()
+        conn.commit()
+        cur.close()
+    return n, last if n else after
+    # ==============================================================================
+# 定时任务 (必须在 Handlers 之前定义)
+# ==============================================================================
+
+# --- 管理员通知 (后台合并发送) ---
+_admin_outbox = {"items": [], "dropped": 0, "task": None, "attempts": 0, "delay": 0}
+
+def notify_admin(text):
+    """投递一条管理员通知后立即返回；窗口期内的多条合并成一条摘要发送"""
+    if not ADMIN_ID or not bot_app:
+        return
+    _queue_admin_notices([text])
+    task = _admin_outbox["task"]
+    if not task or task.done():
+        _admin_outbox["task"] = asyncio.get_running_loop().create_task(admin_digest_task())
+
+def _queue_admin_notices(texts, front=False):
+    items = _admin_outbox["items"]
+    if front:
+        items[:0] = texts
+    else:
+        items.extend(texts)
+    if len(items) > ADMIN_OUTBOX_MAX:
+        _admin_outbox["dropped"] += len(items) - ADMIN_OUTBOX_MAX
+        del items[:-ADMIN_OUTBOX_MAX]
+
+def _digest_chunks(items):
+    """按通知边界分段，每段不超过单条消息上限，不会从 Markdown 实体中间截断"""
+    chunks, size = [[]], 0
+    for text in items:
+        if chunks[-1] and size + len(text) + 2 > ADMIN_MESSAGE_LIMIT:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(text)
+        size += len(text) + 2
+    return chunks
+
+async def _send_admin_text(text):
+    if len(text) > 4096:
+        # 单条通知本身超长：截断后按纯文本发，避免半截实体解析失败
+        await bot_app.bot.send_message(ADMIN_ID, text[:4096], rate_limit_args={"priority": PRIO_BULK})
+        return
+    try:
+        await bot_app.bot.send_message(ADMIN_ID, text, parse_mode='Markdown', rate_limit_args={"priority": PRIO_BULK})
+    except BadRequest as e:
+        if "parse" not in str(e).lower():
+            raise
+        await bot_app.bot.send_message(ADMIN_ID, text, rate_limit_args={"priority": PRIO_BULK})
+
+async def send_admin_digest():
+    """发出积压的通知。网络/限流错误时该段及之后的放回队首，下个窗口重试 (有次数上限)；
+    管理员不可达 (被拉黑、chat 不存在) 丢弃全部，其余 BadRequest 只丢当前段"""
+    items, _admin_outbox["items"] = _admin_outbox["items"], []
+    dropped, _admin_outbox["dropped"] = _admin_outbox["dropped"], 0
+    if dropped:
+        items.append(f"⚠️ 另有 +{dropped} 条较早的通知因积压过多未能送达")
+    if not items:
+        return
+    chunks = _digest_chunks(items)
+    for i, chunk in enumerate(chunks):
+        if len(items) == 1:
+            text = chunk[0]
+        else:
+            part = f" · {i + 1}/{len(chunks)}" if len(chunks) > 1 else ""
+            text = f"📬 **通知汇总 ({len(items)} 条{part})**\n\n" + "\n\n".join(chunk)
+        try:
+            await _send_admin_text(text)
+        except (RetryAfter, NetworkError) as e:
+            if isinstance(e, BadRequest):
+                if "chat not found" in str(e).lower():
+                    logger.warning(f"admin digest undeliverable, dropped {len(items)} items: {e}")
+                    break
+                logger.warning(f"admin digest part rejected, dropped {len(chunk)} items: {e}")
+                continue
+            rest = [t for c in chunks[i:] for t in c]
+            _admin_outbox["attempts"] += 1
+            if _admin_outbox["attempts"] >= ADMIN_DIGEST_MAX_ATTEMPTS:
+                logger.warning(f"admin digest failed {_admin_outbox['attempts']} times, dropped {len(rest)} items: {e}")
+                break
+            if isinstance(e, RetryAfter):
+                _admin_outbox["delay"] = e.retry_after
+            logger.warning(f"admin digest failed, requeued {len(rest)} items: {e}")
+            _queue_admin_notices(rest, front=True)
+            return
+        except Forbidden as e:
+            logger.warning(f"admin digest undeliverable, dropped {len(items)} items: {e}")
+            break
+        except Exception as e:
+            logger.warning(f"admin digest part failed, dropped {len(chunk)} items: {e}")
+    _admin_outbox["attempts"] = 0
+
+async def admin_digest_task():
+    while _admin_outbox["items"]:
+        delay, _admin_outbox["delay"] = _admin_outbox["delay"], 0
+        await asyncio.sleep(max(ADMIN_DIGEST_WINDOW, delay))
+        await send_admin_digest()
+
+async def drain_admin_notices():
+    """关停前把未发出的通知立刻发掉"""
+    task = _admin_outbox["task"]
+    if task and not task.done():
+        task.cancel()
+    await send_admin_digest()
+
+async def flush_stats_task():
+    """定期写回运营统计计数"""
+    try:
+        await asyncio.to_thread(flush_stats)
+    except Exception as e:
+        logger.warning(f"flush stats failed: {e}")
+
+async def flush_clicks_task():
+    """定期写回密钥点击计数"""
+    try:
+        await asyncio.to_thread(flush_click_counters)
+    except Exception as e:
+        logger.warning(f"flush clicks failed: {e}")
+
+async def purge_old_key_epochs():
+    """后台分批清理旧 epoch 的已用密钥记录，批次之间让出事件循环"""
+    total = 0
+    try:
+        while True:
+            n = await asyncio.to_thread(purge_old_key_epochs_batch)
+            total += n
+            if n == 0:
+                break
+            await asyncio.sleep(0.5)
+    except Exception as e:
+        logger.warning(f"purge key epochs failed: {e}")
+    if total:
+        logger.info(f"purged {total} used-key rows from old epochs")
+    return total
+
+async def refresh_point_totals_task():
+    """刷新全站积分汇总物化视图 (CONCURRENTLY，不阻塞读)"""
+    try:
+        await asyncio.to_thread(refresh_point_category_totals)
+    except Exception as e:
+        logger.warning(f"refresh point totals failed: {e}")
+
+async def point_log_partitions_task():
+    """预建积分日志分区并归档超出保留期的旧分区"""
+    try:
+        archived = await asyncio.to_thread(maintain_point_log_partitions)
+    except Exception as e:
+        logger.warning(f"point log partition maintenance failed: {e}")
+        return
+    if archived:
+        logger.info(f"archived point log partitions: {', '.join(archived)}")
+
+async def janitor_task():
+    """分批清理过期的临时数据，每批一个短事务，批间让出数据库与事件循环"""
+    reclaimed = {}
+    for table, key, where, params in janitor_rules():
+        after, total = None, 0
+        try:
+            while True:
+                n, after = await asyncio.to_thread(janitor_delete_batch, table, key, where, params, after)
+                total += n
+                if n < JANITOR_BATCH:
+                    break
+                await asyncio.sleep(JANITOR_PAUSE)
+        except Exception as e:
+            logger.warning(f"janitor {table} failed after {total} rows: {e}")
+        if total:
+            reclaimed[table] = total
+    logger.info(f"janitor reclaimed {sum(reclaimed.values())} rows {reclaimed}")
+    return reclaimed
+
+async def weekly_reset_task():
+    """每周一重置7个密钥"""
+    keys = await asyncio.to_thread(refresh_system_keys_v7)
+    notify_admin("🔔 **每周密钥重置提醒**\n\n已生成新密钥并清空链接。\n请使用 `/my` 重新绑定。")
+    await purge_old_key_epochs()
+
+async def delete_messages_task(chat_id, message_ids):
+    """5分钟后自动删除消息"""
+    try:
+        await asyncio.sleep(300) # 5分钟
+        for msg_id in message_ids:
+            try:
+                await bot_app.bot.delete_message(chat_id=chat_id, message_id=msg_id)
+            except:
+                pass
+        
+        text = "⏳ **消息存在时间有限，已自动销毁。**\n\n请到购买处重新获取（已购买不需要二次付费）。"
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🎁 前往兑换中心", callback_data="go_exchange")],
+            [InlineKeyboardButton("🏠 返回首页", callback_data="back_to_home")]
+        ])
+        await bot_app.bot.send_message(chat_id=chat_id, text=text, reply_markup=kb, parse_mode='Markdown',
+                                       rate_limit_args={"priority": PRIO_FOLLOWUP, "coalesce": f"expired:{chat_id}"})
+    except:
+        pass
+
+# ==============================================================================
+# 集群：leader 选举 (Postgres advisory lock)
+# ==============================================================================
+
+_leader = {"conn": None, "active": False}
+
+def check_leadership():
+    """持有 advisory lock 的会话即 leader；连接断开时锁自动释放"""
+    conn = _leader["conn"]
+    fresh = conn is None or conn.closed
+    if fresh:
+        conn = psycopg2.connect(DATABASE_URL)
+        conn.autocommit = True
+        _leader["conn"] = conn
+    cur = conn.cursor()
+    try:
+        if _leader["active"] and not fresh:
+            cur.execute("SELECT 1")
+            return True
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (LEADER_LOCK_KEY,))
+        return cur.fetchone()[0]
+    except psycopg2.Error:
+        conn.close()
+        _leader["conn"] = None
+        return False
+    finally:
+        if not cur.closed:
+            cur.close()
+
+LEADER_JOB_IDS = {'weekly_reset', 'refresh_point_totals', 'point_log_partitions', 'janitor'}
+
+async def promote_to_leader():
+    """成为 leader：接管定时任务与 Telegram 轮询 (轮询启动成功后才算 active)"""
+    scheduler.add_job(weekly_reset_task, 'cron', day_of_week='mon', hour=0, timezone=tz_bj, id='weekly_reset', replace_existing=True)
+    scheduler.add_job(refresh_point_totals_task, 'cron', minute=5, id='refresh_point_totals', replace_existing=True)
+    scheduler.add_job(point_log_partitions_task, 'cron', hour=3, minute=20, timezone=tz_bj, id='point_log_partitions', replace_existing=True)
+    scheduler.add_job(janitor_task, 'cron', hour=4, minute=40, timezone=tz_bj, id='janitor', replace_existing=True)
+    asyncio.create_task(purge_old_key_epochs())
+    if CLUSTER_MODE:
+        await reload_bot_persistence()
+        await load_asset_registry()
+    await bot_app.updater.start_polling(allowed_updates=Update.ALL_TYPES, timeout=POLL_TIMEOUT)
+    _leader["active"] = True
+    logger.info(f"instance {INSTANCE_ID} is now leader")
+
+async def demote_from_leader():
+    _leader["active"] = False
+    for job in scheduler.get_jobs():
+        if job.id in LEADER_JOB_IDS:
+            job.remove()
+    if bot_app and bot_app.updater.running:
+        await bot_app.updater.stop()
+        await bot_app.update_persistence()
+        await bot_app.persistence.flush()
+    logger.info(f"instance {INSTANCE_ID} stepped down")
+
+def release_leader_lock():
+    """关闭持锁会话即释放 advisory lock，让其它 worker 接手"""
+    conn, _leader["conn"] = _leader["conn"], None
+    if conn and not conn.closed:
+        conn.close()
+
+async def abandon_leadership():
+    """上任/卸任中途出错：尽量清理任务与轮询，并放掉锁"""
+    try:
+        await demote_from_leader()
+    except Exception as e:
+        logger.warning(f"demote failed: {e}")
+    _leader["active"] = False
+    await asyncio.to_thread(release_leader_lock)
+
+async def leader_election_loop():
+    while True:
+        try:
+            ensure_cache_listener()
+        except Exception as e:
+            logger.warning(f"cache listener failed: {e}")
+        try:
+            is_leader = await asyncio.to_thread(check_leadership)
+        except Exception as e:
+            logger.warning(f"leader check failed: {e}")
+            is_leader = False
+        try:
+            if is_leader and not _leader["active"]:
+                await promote_to_leader()
+            elif not is_leader and _leader["active"]:
+                await demote_from_leader()
+        except Exception as e:
+            logger.warning(f"leader transition failed: {e}")
+            await abandon_leadership()
+        await asyncio.sleep(LEADER_CHECK_SECONDS)
+
+# ==============================================================================
+# 会话持久化 (Postgres)
+# ==============================================================================
+
+class PostgresPersistence(BasePersistence):
+    """ConversationHandler 状态与 user_data 落库，重启/发版后用户可继续支付流程。
+    PTB 每 update_interval 秒回调一次 update_*，这里只暂存内容真正变化的条目，
+    同一轮的所有变化合并成一个事务批量写入。"""
+
+    def __init__(self, update_interval=PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._snapshot = {}  # (kind, key) -> 已落库的 JSON
+        self._pending = {}   # (kind, key) -> 待写 JSON，None 表示删除
+        self._flush_task = None
+        self._draining = False  # flush() 期间失败不再退避重试，交给调用方
+        self._wake = asyncio.Event()  # flush() 唤醒退避中的重试
+
+    @staticmethod
+    def _load(kind):
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT key, data FROM bot_persistence_v8 WHERE kind=%s", (kind,))
+            rows = cur.fetchall()
+            cur.close()
+        return rows
+
+    @staticmethod
+    def _write(batch):
+        upserts = [(k[0], k[1], v) for k, v in batch.items() if v is not None]
+        deletes = [k for k, v in batch.items() if v is None]
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            if upserts:
+                psycopg2.extras.execute_values(cur, """
+                    INSERT INTO bot_persistence_v8 (kind, key, data) VALUES %s
+                    ON CONFLICT (kind, key) DO UPDATE SET data=EXCLUDED.data, updated_at=CURRENT_TIMESTAMP
+                """, upserts)
+            if deletes:
+                psycopg2.extras.execute_values(cur, "DELETE FROM bot_persistence_v8 t USING (VALUES %s) AS d(kind, key) WHERE t.kind=d.kind AND t.key=d.key", deletes)
+            conn.commit()
+            cur.close()
+
+    def _stage(self, kind, key, data):
+        if self._snapshot.get((kind, key)) == data and (kind, key) not in self._pending:
+            return
+        self._pending[(kind, key)] = data
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_pending())
+
+    async def _flush_pending(self):
+        """写到 _pending 为空为止：写入期间新暂存的条目接着写，失败则指数退避后重试"""
+        await asyncio.sleep(0)  # 等同一轮的 update_* 全部暂存完
+        delay = 1
+        while self._pending:
+            batch, self._pending = self._pending, {}
+            try:
+                await asyncio.to_thread(self._write, batch)
+                self._snapshot.update(batch)
+                for k in [k for k, v in batch.items() if v is None]:
+                    self._snapshot.pop(k, None)
+                delay = 1
+            except Exception as e:
+                for k, v in batch.items():
+                    self._pending.setdefault(k, v)
+                if self._draining:
+                    logger.warning(f"persistence flush failed, {len(self._pending)} entries unsaved: {e}")
+                    return
+                logger.warning(f"persistence flush failed, retrying in {delay}s: {e}")
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                delay = min(delay * 2, PERSISTENCE_RETRY_MAX)
+
+    async def get_user_data(self):
+        rows = await asyncio.to_thread(self._load, 'user')
+        self._snapshot.update((('user', k), d) for k, d in rows)
+        return {int(k): json.loads(d) for k, d in rows}
+
+    async def get_conversations(self, name):
+        rows = await asyncio.to_thread(self._load, f'conv:{name}')
+        self._snapshot.update(((f'conv:{name}', k), d) for k, d in rows)
+        return {tuple(json.loads(k)): json.loads(d) for k, d in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        self._stage(f'conv:{name}', json.dumps(list(key)), None if new_state is None else json.dumps(new_state))
+
+    async def update_user_data(self, user_id, data):
+        self._stage('user', str(user_id), json.dumps(data, default=str, sort_keys=True, ensure_ascii=False) if data else None)
+
+    async def drop_user_data(self, user_id):
+        self._stage('user', str(user_id), None)
+
+    async def flush(self):
+        self._draining = True
+        self._wake.set()
+        try:
+            if self._flush_task and not self._flush_task.done():
+                await self._flush_task
+            await self._flush_pending()
+        finally:
+            self._draining = False
+            self._wake.clear()
+
+    # 以下数据不持久化
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
 
-def get_ad_status(uid):
-    ensure_user_exists(uid)
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT daily_watch_count FROM user_ads_v3 WHERE user_id=%s", (uid,))
-    row = cur.fetchone()
-    cnt = row[0] if row else 0
-    cur.close()
-    conn.close()
-    return cnt
+    async def refresh_bot_data(self, bot_data):
+        pass
 
-def get_user_click_status(uid):
-    s = get_session_date()
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT click_count, session_date FROM user_key_clicks_v3 WHERE user_id=%s", (uid,))
-    row = cur.fetchone()
-    if not row or row[1] != s:
-        cur.execute("INSERT INTO user_key_clicks_v3 (user_id,click_count,session_date) VALUES (%s,0,%s) ON CONFLICT(user_id) DO UPDATE SET click_count=0,session_date=%s", (uid, s, s))
-        conn.commit()
-        cur.close()
-        conn.close()
-        return 0
-    cur.close()
-    conn.close()
-    return row[0]
+async def reload_bot_persistence():
+    """follower 接任 leader 时重新载入会话状态 (启动时载入的数据可能已过期)"""
+    await bot_app._initialize_persistence()
+    for handlers in bot_app.handlers.values():
+        for h in handlers:
+            if isinstance(h, ConversationHandler) and h.persistent:
+                await bot_app._add_ch_to_persistence(h)
 
-def increment_user_click(uid):
-    s = get_session_date()
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE user_key_clicks_v3 SET click_count=click_count+1 WHERE user_id=%s AND session_date=%s", (uid, s))
-    conn.commit()
-    cur.close()
-    conn.close()
-    # ==============================================================================
-# 定时任务 (必须在 Handlers 之前定义)
+# ==============================================================================
+# 出站限速 (优先级)
 # ==============================================================================
 
-async def daily_reset_task():
-    """每日0点重置任务 (保留接口)"""
-    pass
+PRIO_INTERACTIVE, PRIO_FOLLOWUP, PRIO_BULK = 0, 1, 2
+FANOUT = {"priority": PRIO_FOLLOWUP}  # 频道转发库的批量内容
 
-async def weekly_reset_task():
-    """每周一重置7个密钥"""
-    keys = refresh_system_keys_v7()
-    msg = "🔔 **每周密钥重置提醒**\n\n已生成新密钥并清空链接。\n请使用 `/my` 重新绑定。"
-    if bot_app and ADMIN_ID:
-        try:
-            await bot_app.bot.send_message(ADMIN_ID, msg, parse_mode='Markdown')
-        except:
-            pass
+class PriorityRateLimiter(BaseRateLimiter):
+    """所有 Bot API 发送都经过这里。
+    rate_limit_args={"priority": PRIO_*, "coalesce": key}：
+    - 全局按 SEND_RATE 发放时间片，有更高优先级在等时低优先级让路；
+    - 非交互消息同一会话至少间隔 CHAT_SEND_INTERVAL 秒；
+    - 同一 coalesce 键排队中只保留最新一条，被替换的请求直接返回 None。"""
 
-async def delete_messages_task(chat_id, message_ids):
-    """5分钟后自动删除消息"""
-    try:
-        await asyncio.sleep(300) # 5分钟
-        for msg_id in message_ids:
-            try:
-                await bot_app.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-            except:
-                pass
-        
-        text = "⏳ **消息存在时间有限，已自动销毁。**\n\n请到购买处重新获取（已购买不需要二次付费）。"
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🎁 前往兑换中心", callback_data="go_exchange")],
-            [InlineKeyboardButton("🏠 返回首页", callback_data="back_to_home")]
-        ])
-        await bot_app.bot.send_message(chat_id=chat_id, text=text, reply_markup=kb, parse_mode='Markdown')
-    except:
+    PACED_ENDPOINTS = {
+        "sendMessage", "sendPhoto", "sendVideo", "sendDocument", "sendMediaGroup",
+        "copyMessage", "forwardMessage", "editMessageText", "editMessageCaption", "editMessageReplyMarkup",
+    }
+
+    def __init__(self, rate=SEND_RATE, chat_interval=CHAT_SEND_INTERVAL, max_retries=2):
+        self._interval = 1 / rate
+        self._chat_interval = chat_interval
+        self._max_retries = max_retries
+        self._next_slot = 0.0
+        self._chat_next = {}
+        self._waiting = [0, 0, 0]
+        self._coalesce = {}  # key -> 最新请求的序号
+        self._seq = 0
+
+    async def initialize(self):
         pass
 
+    async def shutdown(self):
+        pass
+
+    async def _acquire(self, prio, chat_id):
+        loop = asyncio.get_running_loop()
+        self._waiting[prio] += 1
+        try:
+            while True:
+                now = loop.time()
+                if any(self._waiting[:prio]):
+                    wait = self._interval
+                else:
+                    wait = self._next_slot - now
+                    if prio > PRIO_INTERACTIVE and chat_id is not None:
+                        wait = max(wait, self._chat_next.get(chat_id, 0) - now)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self._next_slot = max(now, self._next_slot) + self._interval
+            if chat_id is not None:
+                if len(self._chat_next) > 10000:
+                    self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+                self._chat_next[chat_id] = now + self._chat_interval
+        finally:
+            self._waiting[prio] -= 1
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint not in self.PACED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+        opts = rate_limit_args if isinstance(rate_limit_args, dict) else {}
+        prio = opts.get("priority", PRIO_INTERACTIVE)
+        key = opts.get("coalesce")
+        if key is not None:
+            self._seq += 1
+            seq = self._coalesce[key] = self._seq
+        chat_id = data.get("chat_id")
+        try:
+            for attempt in range(self._max_retries + 1):
+                await self._acquire(prio, chat_id)
+                if key is not None and self._coalesce.get(key) != seq:
+                    return None
+                try:
+                    return await callback(*args, **kwargs)
+                except RetryAfter as e:
+                    if attempt == self._max_retries:
+                        raise
+                    logger.warning(f"{endpoint} flood wait {e.retry_after}s")
+                    self._next_slot = asyncio.get_running_loop().time() + float(e.retry_after)
+        finally:
+            if key is not None and self._coalesce.get(key) == seq:
+                del self._coalesce[key]
+
 # ==============================================================================
 # Telegram Handlers (核心交互)
 # ==============================================================================
 
+# --- 回调数据路由 ---
+# v1 编码：路由名[:参数1:参数2...]，无参数的按钮保持原名 (会话入口仍按原名匹配)。
+# v0 旧格式：路由名_参数1_参数2，仅用于解析历史消息上的按钮。
+CB_SEP = ":"
+CALLBACK_ROUTES = {}
+
+def cb(route, *args):
+    data = CB_SEP.join([route, *map(str, args)])
+    if len(data.encode()) > 64:
+        raise ValueError(f"callback_data 超长: {data}")
+    return data
+
+def parse_callback(data):
+    if CB_SEP in data:
+        route, *args = data.split(CB_SEP)
+        return route, args
+    route, args = data, []
+    for _ in range(3):
+        if route in CALLBACK_ROUTES or "_" not in route:
+            break
+        route, arg = route.rsplit("_", 1)
+        args.insert(0, arg)
+    return route, args
+
+# --- 菜单渲染缓存 ---
+# 键盘对象只依赖少数状态标志，按标志组合缓存，处理器里不再逐次构建。
+START_TEXT = "👋 欢迎加入【VIP中转】！我是守门员小卫，你的身份验证小助手~\n\n📢 小卫小卫，守门员小卫！\n一键入群，小卫帮你搞定！\n新人来报到，小卫查身份！"
+QUARK_KEY_TEXT = (
+    "🔑 **免费获取解锁密钥**\n\n"
+    "1. 点击下方按钮跳转网盘\n"
+    "2. 保存文件，文件名即为密钥 (如 `KEY123.zip`)\n"
+    "3. 复制文件名 (去掉后缀) 发送给机器人\n"
+    "4. **任意一个密钥** 即可解锁今日兑换权限！\n\n"
+    "⚠️ 注意：每个密钥 7 天内只能使用一次。"
+)
+
+@functools.lru_cache(maxsize=256)
+def start_menu(verify_text, verify_cb):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(verify_text, callback_data=verify_cb)],
+        [InlineKeyboardButton("💰 积分中心", callback_data="my_points")],
+        [InlineKeyboardButton("🎉 开业活动", callback_data="open_activity")]
+    ])
+
+@functools.lru_cache(maxsize=4)
+def points_menu(vip_state):
+    """vip_state: bought / lock / buy"""
+    vip_btn = {
+        'bought': InlineKeyboardButton("✅ 你已购买", callback_data=cb("noop", "vip_bought")),
+        'lock': InlineKeyboardButton("🚫 购买冷却中", callback_data=cb("noop", "vip_lock")),
+        'buy': InlineKeyboardButton("💎 购买月卡 (终身)", callback_data="buy_vip_card"),
+    }[vip_state]
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📅 每日签到", callback_data="do_checkin")],
+        [InlineKeyboardButton("🎁 兑换中心", callback_data="go_exchange")],
+        [InlineKeyboardButton("🔑 获取密钥 (7密钥)", callback_data="get_quark_key_v7")],
+        [vip_btn],
+        [InlineKeyboardButton("📜 余额记录", callback_data="view_balance")]
+    ])
+
+@functools.lru_cache(maxsize=128)
+def quark_key_menu(present):
+    """present: 7 个网盘位是否已配置链接 (按钮只带序号，链接本身由 /jump 读取)"""
+    kb = []
+    for label, idx in (("百度", range(1, 3)), ("夸克", range(3, 6)), ("夸克", range(6, 8))):
+        row = []
+        for i in idx:
+            if present[i - 1]:
+                row.append(InlineKeyboardButton(f"{label} {i}", url=f"https://{RAILWAY_DOMAIN}/jump?key_index={i}"))
+            else:
+                row.append(InlineKeyboardButton(f"{label} {i} (空)", callback_data=cb("noop", "empty")))
+        kb.append(row)
+    kb.append([InlineKeyboardButton("🔙 返回积分中心", callback_data="my_points")])
+    return InlineKeyboardMarkup(kb)
+
+@functools.lru_cache(maxsize=1)
+def admin_menu():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🖼 File ID 管理", callback_data="start_upload")],
+        [InlineKeyboardButton("📚 频道转发库", callback_data="manage_cmds_entry")],
+        [InlineKeyboardButton("🛍 商品管理", callback_data="manage_products_entry")],
+        [InlineKeyboardButton("👥 用户与记录", callback_data="list_users")],
+        [InlineKeyboardButton("📊 积分汇总", callback_data="point_totals"), InlineKeyboardButton("📈 运营数据", callback_data="stats")]
+    ])
+
+@functools.lru_cache(maxsize=1)
+def products_menu():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("➕ 上架新商品", callback_data="add_product_start")],
+        [InlineKeyboardButton("📥 批量导入 (CSV/JSON)", callback_data="import_products_start")],
+        [InlineKeyboardButton("📂 管理/下架商品", callback_data=cb("list_admin_prods", 0))],
+        [InlineKeyboardButton("🔙 返回后台", callback_data="back_to_admin")]
+    ])
+
+@functools.lru_cache(maxsize=1)
+def cmds_menu():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("➕ 添加新命令", callback_data="add_new_cmd")],
+        [InlineKeyboardButton("📂 管理/删除命令", callback_data=cb("list_cmds", 0))],
+        [InlineKeyboardButton("🔙 返回后台", callback_data="back_to_admin")]
+    ])
+
+# --- 编辑去重 ---
+# 记录每条消息最后一次渲染内容的哈希，内容相同的编辑直接跳过 (回调已由处理器 answer)。
+_rendered = OrderedDict()  # (chat_id, message_id) -> hash
+
+async def safe_edit(query, text, reply_markup=None, parse_mode=None, **kwargs):
+    msg = query.message
+    key = (msg.chat_id, msg.message_id) if msg else None
+    digest = hash((text, parse_mode, reply_markup))
+    if key and _rendered.get(key) == digest:
+        _rendered.move_to_end(key)
+        return False
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode, **kwargs)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+    if key:
+        _rendered[key] = digest
+        _rendered.move_to_end(key)
+        if len(_rendered) > EDIT_TRACK_SIZE:
+            _rendered.popitem(last=False)
+    return True
+
+async def route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """所有非会话内按钮的统一入口：一次字典查找分发"""
+    query = update.callback_query
+    route, args = parse_callback(query.data or "")
+    handler = CALLBACK_ROUTES.get(route)
+    if not handler:
+        await query.answer()
+        return
+    context.args = args
+    return await handler(update, context)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     ensure_user_exists(user.id, user.username)
@@ -627,30 +2491,23 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if is_done:
         verify_text = "✅ 已加入会员群"
-        verify_cb = "noop_verify_done"
+        verify_cb = cb("noop", "verify_done")
     elif lock_until and datetime.now() < lock_until:
         rem = lock_until - datetime.now()
         h, m = int(rem.seconds // 3600), int((rem.seconds % 3600) // 60)
         verify_text = f"🚫 验证锁定 ({h}h{m}m)"
         verify_cb = "locked_verify"
 
-    text = "👋 欢迎加入【VIP中转】！我是守门员小卫，你的身份验证小助手~\n\n📢 小卫小卫，守门员小卫！\n一键入群，小卫帮你搞定！\n新人来报到，小卫查身份！"
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton(verify_text, callback_data=verify_cb)],
-        [InlineKeyboardButton("💰 积分中心", callback_data="my_points")],
-        [InlineKeyboardButton("🎉 开业活动", callback_data="open_activity")]
-    ])
+    kb = start_menu(verify_text, verify_cb)
     
     if update.callback_query:
         if update.callback_query.data == "locked_verify":
             await update.callback_query.answer("⛔️ 请稍后再试。", show_alert=True)
             return
-        if update.callback_query.data == "noop_verify_done":
-            await update.callback_query.answer("✅ 您已完成验证，无需重复。", show_alert=True)
-            return
-        await update.callback_query.edit_message_text(text, reply_markup=kb)
+        await update.callback_query.answer()
+        await safe_edit(update.callback_query, START_TEXT, reply_markup=kb)
     else:
-        await update.message.reply_text(text, reply_markup=kb)
+        await update.message.reply_text(START_TEXT, reply_markup=kb)
 
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """通用取消命令 /c"""
@@ -670,27 +2527,19 @@ async def jf_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # 购买月卡按钮状态
     _, v_lock, _ = check_lock(user.id, 'vip_buy')
     if is_v:
-        vip_btn_text = "✅ 你已购买"
-        vip_btn_cb = "noop_vip_bought"
+        vip_state = 'bought'
     elif v_lock and datetime.now() < v_lock:
-        vip_btn_text = "🚫 购买冷却中"
-        vip_btn_cb = "noop_vip_lock"
+        vip_state = 'lock'
     else:
-        vip_btn_text = "💎 购买月卡 (终身)"
-        vip_btn_cb = "buy_vip_card"
+        vip_state = 'buy'
 
     text = f"💰 **积分中心**\n\n👤 用户：{user.first_name} (`{user.id}`)\n{vip_status}\n💰 积分余额：`{data[0]}`"
     
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("📅 每日签到", callback_data="do_checkin")],
-        [InlineKeyboardButton("🎁 兑换中心", callback_data="go_exchange")],
-        [InlineKeyboardButton("🔑 获取密钥 (7密钥)", callback_data="get_quark_key_v7")],
-        [InlineKeyboardButton(vip_btn_text, callback_data=vip_btn_cb)],
-        [InlineKeyboardButton("📜 余额记录", callback_data="view_balance")]
-    ])
+    kb = points_menu(vip_state)
     
     if update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=kb, parse_mode='Markdown')
+        await update.callback_query.answer()
+        await safe_edit(update.callback_query, text, reply_markup=kb, parse_mode='Markdown')
     else:
         await update.message.reply_text(text, reply_markup=kb, parse_mode='Markdown')
 
@@ -699,17 +2548,23 @@ async def view_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     uid = update.effective_user.id
     data = get_user_data(uid)
-    logs = get_point_logs(uid, 10)
+    recent, summary = get_point_overview(uid)
+    if recent is None:
+        # 汇总上线前没有积分变动的老用户，回退读日志
+        recent = [[l[0], l[1], l[2].strftime('%Y-%m-%d %H:%M:%S')] for l in get_point_logs(uid, POINT_RECENT_SIZE)]
     
     log_text = ""
-    if logs:
-        for l in logs:
-            log_text += f"• {l[2].strftime('%m-%d %H:%M')} | {int(l[0]):+d} | {l[1]}\n"
+    if recent:
+        for amt, reason, ts in recent:
+            log_text += f"• {ts[5:16]} | {int(amt):+d} | {reason}\n"
     else:
         log_text = "暂无记录"
+    sum_text = "".join(f"• {c or '其他'}：{int(t):+d} ({n}次)\n" for c, t, n in summary)
         
     text = f"💳 **账户余额**\n\n💎 总积分：`{data[0]}`\n\n📝 **最近记录：**\n{log_text}"
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="my_points")]]), parse_mode='Markdown')
+    if sum_text:
+        text += f"\n📊 **分类汇总：**\n{sum_text}"
+    await safe_edit(query, text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="my_points")]]), parse_mode='Markdown')
 
 async def recharge_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -720,16 +2575,16 @@ async def recharge_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     _, ali_l, ali_d = check_lock(uid, 'ali')
     
     if wx_d:
-        wx_t, wx_c = "✅ 微信已充", "noop_done"
+        wx_t, wx_c = "✅ 微信已充", cb("noop", "done")
     elif wx_l and datetime.now() < wx_l:
-        wx_t, wx_c = "🚫 3小时冷却", "noop_lock"
+        wx_t, wx_c = "🚫 3小时冷却", cb("noop", "lock")
     else:
         wx_t, wx_c = "💚 微信充值", "pay_wx"
         
     if ali_d:
-        ali_t, ali_c = "✅ 支付宝已充", "noop_done"
+        ali_t, ali_c = "✅ 支付宝已充", cb("noop", "done")
     elif ali_l and datetime.now() < ali_l:
-        ali_t, ali_c = "🚫 3小时冷却", "noop_lock"
+        ali_t, ali_c = "🚫 3小时冷却", cb("noop", "lock")
     else:
         ali_t, ali_c = "💙 支付宝充值", "pay_ali"
     
@@ -737,20 +2592,19 @@ async def recharge_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton(wx_t, callback_data=wx_c), InlineKeyboardButton(ali_t, callback_data=ali_c)],
         [InlineKeyboardButton("🔙 返回", callback_data="my_points")]
     ])
-    await query.edit_message_text("💎 **充值中心**\n每种方式限充 1 次。", reply_markup=kb, parse_mode='Markdown')
+    await safe_edit(query, "💎 **充值中心**\n每种方式限充 1 次。", reply_markup=kb, parse_mode='Markdown')
+
+NOOP_ALERTS = {
+    "vip_bought": "✅ 您已是尊贵的终身会员，无需重复购买！",
+    "vip_lock": "⛔️ 购买尝试次数过多，请 10 分钟后再试。",
+    "verify_done": "✅ 您已完成验证，无需重复。",
+    "done": "✅ 已完成",
+    "empty": "⚠️ 此位置暂无链接，请尝试其他按钮。",
+}
 
 async def noop_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    if "vip_bought" in query.data:
-        await query.answer("✅ 您已是尊贵的终身会员，无需重复购买！", show_alert=True)
-    elif "vip_lock" in query.data:
-        await query.answer("⛔️ 购买尝试次数过多，请 10 分钟后再试。", show_alert=True)
-    elif "done" in query.data:
-        await query.answer("✅ 已完成", show_alert=True)
-    elif "empty" in query.data:
-        await query.answer("⚠️ 此位置暂无链接，请尝试其他按钮。", show_alert=True)
-    else:
-        await query.answer("⛔️ 暂时锁定", show_alert=True)
+    reason = "_".join(context.args or [])
+    await update.callback_query.answer(NOOP_ALERTS.get(reason, "⛔️ 暂时锁定"), show_alert=True)
 
 async def checkin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -759,7 +2613,7 @@ async def checkin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("⚠️ 今日已签到", show_alert=True)
     else:
         kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_to_home")]])
-        await query.edit_message_text(f"🎉 **签到成功！** +{res['added']}分", reply_markup=kb, parse_mode='Markdown')
+        await safe_edit(query, f"🎉 **签到成功！** +{res['added']}分", reply_markup=kb, parse_mode='Markdown')
 
 async def activity_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -780,13 +2634,14 @@ async def activity_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if count < 3:
         kb.append([InlineKeyboardButton(f"📺 去看视频 ({count}/3)", url=w_url)])
     else:
-        kb.append([InlineKeyboardButton("✅ 视频已完成 (3/3)", callback_data="noop_done")])
+        kb.append([InlineKeyboardButton("✅ 视频已完成 (3/3)", callback_data=cb("noop", "done"))])
         
     kb.append([InlineKeyboardButton("🛠 测试按钮", url=test_url)])
     kb.append([InlineKeyboardButton("🔙 返回", callback_data="back_to_home")])
     
     if update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
+        await update.callback_query.answer()
+        await safe_edit(update.callback_query, text, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
     else:
         await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
 
@@ -806,33 +2661,16 @@ async def cz_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def verify_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    fid = get_file_id("START_VIP_INFO")
     kb = InlineKeyboardMarkup([[InlineKeyboardButton("✅ 我已付款，开始验证", callback_data="paid_start")]])
     text = "💎 **VIP会员特权说明：**\n✅ 专属中转通道\n✅ 优先审核入群\n✅ 7x24小时客服支持\n✅ 定期福利活动"
-    
-    if fid:
-        try:
-            await query.message.reply_photo(fid, caption=text, reply_markup=kb, parse_mode='Markdown')
-            await query.delete_message()
-        except:
-            await query.edit_message_text(text, reply_markup=kb, parse_mode='Markdown')
-    else:
-        await query.edit_message_text(text, reply_markup=kb, parse_mode='Markdown')
+    await reply_with_asset(query, "START_VIP_INFO", text, reply_markup=kb, replace=True)
     return WAITING_START_ORDER
 
 async def ask_start_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    fid = get_file_id("START_TUTORIAL")
     text = "📝 **查找订单号教程：**\n请在支付账单中找到【订单号】。\n👇 **请在下方直接回复您的订单号：**"
-    
-    if fid:
-        try:
-            await query.message.reply_photo(fid, caption=text, parse_mode='Markdown')
-        except:
-            await query.message.reply_text(text, parse_mode='Markdown')
-    else:
-        await query.message.reply_text(text, parse_mode='Markdown')
+    await reply_with_asset(query, "START_TUTORIAL", text)
     return WAITING_START_ORDER
 
 async def check_start_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -847,8 +2685,7 @@ async def check_start_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await start(update, context)
         return ConversationHandler.END
     else:
-        fails, _, _ = check_lock(user_id, 'verify')
-        new_fails = update_fail(user_id, 'verify', fails, 3 * 60)
+        new_fails = update_fail(user_id, 'verify')
         
         if new_fails >= 2:
             await update.message.reply_text("❌ **验证失败 (2/2)**\n⚠️ 已锁定 3 小时。", parse_mode='Markdown')
@@ -865,34 +2702,17 @@ async def recharge_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     pt = 'wx' if query.data == 'pay_wx' else 'ali'
     context.user_data['pay_type'] = pt
-    fid = get_file_id("WX_PAY_QR" if pt == 'wx' else "ALI_PAY_QR")
     text = f"💎 **{'微信' if pt == 'wx' else '支付宝'}充值**\n💰 5元 = 100积分\n⚠️ **限充 1 次，请勿重复。**"
     kb = InlineKeyboardMarkup([[InlineKeyboardButton("✅ 我已支付，开始验证", callback_data="paid_recharge")]])
-    
-    if fid:
-        try:
-            await query.message.reply_photo(fid, caption=text, reply_markup=kb, parse_mode='Markdown')
-            await query.delete_message()
-        except:
-            await query.edit_message_text(text, reply_markup=kb, parse_mode='Markdown')
-    else:
-        await query.edit_message_text(text, reply_markup=kb, parse_mode='Markdown')
+    await reply_with_asset(query, "WX_PAY_QR" if pt == 'wx' else "ALI_PAY_QR", text, reply_markup=kb, replace=True)
     return WAITING_RECHARGE_ORDER
 
 async def ask_recharge_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     pt = context.user_data.get('pay_type', 'wx')
-    fid = get_file_id("WX_ORDER_TUTORIAL" if pt == 'wx' else "ALI_ORDER_TUTORIAL")
     text = f"📝 **验证步骤：**\n请查找{'交易单号' if pt == 'wx' else '商家订单号'}。\n👇 请输入订单号："
-    
-    if fid:
-        try:
-            await query.message.reply_photo(fid, caption=text, parse_mode='Markdown')
-        except:
-            await query.message.reply_text(text, parse_mode='Markdown')
-    else:
-        await query.message.reply_text(text, parse_mode='Markdown')
+    await reply_with_asset(query, "WX_ORDER_TUTORIAL" if pt == 'wx' else "ALI_ORDER_TUTORIAL", text)
     return WAITING_RECHARGE_ORDER
 
 async def check_recharge_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -909,8 +2729,7 @@ async def check_recharge_order(update: Update, context: ContextTypes.DEFAULT_TYP
         await jf_command_handler(update, context)
         return ConversationHandler.END
     else:
-        fails, _, _ = check_lock(user_id, pt)
-        new_fails = update_fail(user_id, pt, fails, 3 * 60)
+        new_fails = update_fail(user_id, pt)
         
         if new_fails >= 2:
             await update.message.reply_text("❌ **失败 (2/2)**\n⚠️ 此渠道锁定 3 小时。", parse_mode='Markdown')
@@ -931,7 +2750,6 @@ async def buy_vip_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.reply_text("✅ 您已是终身会员，无需重复购买！")
         return ConversationHandler.END
         
-    fid = get_file_id("ALI_PAY_QR")
     text = (
         "🏆 **开通终身月卡会员**\n\n"
         "💰 价格：**5元** (终身有效)\n"
@@ -939,30 +2757,14 @@ async def buy_vip_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "👇 请使用 **支付宝** 扫码支付："
     )
     kb = InlineKeyboardMarkup([[InlineKeyboardButton("✅ 我已付款，开始验证", callback_data="paid_vip")]])
-    
-    if fid:
-        try:
-            await query.message.reply_photo(fid, caption=text, reply_markup=kb, parse_mode='Markdown')
-            await query.delete_message()
-        except:
-            await query.edit_message_text(text, reply_markup=kb, parse_mode='Markdown')
-    else:
-        await query.edit_message_text(text, reply_markup=kb, parse_mode='Markdown')
-        
+    await reply_with_asset(query, "ALI_PAY_QR", text, reply_markup=kb, replace=True)
     return WAITING_VIP_ORDER
 
 async def ask_vip_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    fid = get_file_id("ALI_ORDER_TUTORIAL")
     text = "📝 **验证步骤：**\n请复制 **商家订单号**\n\n👇 **请在下方输入订单号：**"
-    if fid:
-        try:
-            await query.message.reply_photo(fid, caption=text, parse_mode='Markdown')
-        except:
-            await query.message.reply_text(text, parse_mode='Markdown')
-    else:
-        await query.message.reply_text(text, parse_mode='Markdown')
+    await reply_with_asset(query, "ALI_ORDER_TUTORIAL", text)
     return WAITING_VIP_ORDER
 
 async def check_vip_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -971,18 +2773,13 @@ async def check_vip_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if txt.startswith("4768"):
         activate_vip(user.id)
+        notify_admin(f"💰 **新会员入账！**\n用户：{user.first_name} (`{user.id}`)")
         await update.message.reply_text("🎉 **恭喜成为尊贵的终身会员！**", parse_mode='Markdown')
-        if ADMIN_ID:
-            try:
-                await context.bot.send_message(chat_id=ADMIN_ID, text=f"💰 **新会员入账！**\n用户：{user.first_name} (`{user.id}`)", parse_mode='Markdown')
-            except:
-                pass
         await asyncio.sleep(2)
         await jf_command_handler(update, context)
         return ConversationHandler.END
     else:
-        fails, _, _ = check_lock(user.id, 'vip_buy')
-        new_fails = update_fail(user.id, 'vip_buy', fails, 10) # 10分钟
+        new_fails = update_fail(user.id, 'vip_buy')
         
         if new_fails >= 2:
             await update.message.reply_text("❌ **验证失败 (2/2)**\n⚠️ 锁定 10 分钟。", parse_mode='Markdown')
@@ -1019,17 +2816,15 @@ async def dh_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-    offset = 0
-    if update.callback_query and "list_prod_" in update.callback_query.data:
-        offset = int(update.callback_query.data.split("_")[-1])
+    offset = int(context.args[0]) if update.callback_query and context.args else 0
         
-    rows, total = get_products_list(limit=10, offset=offset)
+    rows, total = await asyncio.to_thread(get_products_list, 10, offset)
     is_v, _ = is_vip(user_id)
     daily_used, has_free = check_daily_free(user_id)
     
     kb = []
     # 始终存在的测试按钮
-    kb.append([InlineKeyboardButton("🎁 测试商品 (0积分)", callback_data="confirm_buy_test")])
+    kb.append([InlineKeyboardButton("🎁 测试商品 (0积分)", callback_data=cb("confirm_buy", "test"))])
     
     # 数据库商品
     for r in rows:
@@ -1037,19 +2832,19 @@ async def dh_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         is_bought = check_purchase(user_id, r[0])
         if is_bought:
             btn_text = f"✅ {r[1]} (已兑换)"
-            callback = f"view_bought_{r[0]}"
+            callback = cb("view_bought", r[0])
         else:
             price_text = f"{r[2]}积分"
             if is_v and has_free:
                 price_text = "免费(会员)"
             btn_text = f"🎁 {r[1]} ({price_text})"
-            callback = f"confirm_buy_{r[0]}"
+            callback = cb("confirm_buy", r[0])
         kb.append([InlineKeyboardButton(btn_text, callback_data=callback)])
         
     # 翻页
     nav = []
-    if offset > 0: nav.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"list_prod_{offset-10}"))
-    if offset + 10 < total: nav.append(InlineKeyboardButton("➡️ 下一页", callback_data=f"list_prod_{offset+10}"))
+    if offset > 0: nav.append(InlineKeyboardButton("⬅️ 上一页", callback_data=cb("list_prod", offset - 10)))
+    if offset + 10 < total: nav.append(InlineKeyboardButton("➡️ 下一页", callback_data=cb("list_prod", offset + 10)))
     if nav: kb.append(nav)
     
     kb.append([InlineKeyboardButton("🔙 返回首页", callback_data="back_to_home")])
@@ -1059,141 +2854,110 @@ async def dh_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text += f"\n👑 会员特权：今日已免 {daily_used}/5 单"
         
     if update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
+        try:
+            await update.callback_query.answer()
+        except BadRequest:
+            pass  # 兑换成功后刷新列表时，该回调已应答过
+        await safe_edit(update.callback_query, text, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
     else:
         await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
 
-async def exchange_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """处理购买确认与发货"""
+async def view_bought_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看已兑换商品内容"""
     query = update.callback_query
     await query.answer()
-    data = query.data
     uid = update.effective_user.id
+    pid = int(context.args[0])
+    prod = await asyncio.to_thread(get_product_details, pid)
+    if not prod:
+        await query.answer("商品不存在", show_alert=True)
+        return
+    
+    content = prod[3] or "无文本"
+    fid = prod[4]
+    ftype = prod[5]
     
-    if data == "confirm_buy_test":
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("✅ 确认", callback_data="do_buy_test"), InlineKeyboardButton("❌ 取消", callback_data="list_prod_0")]])
-        await query.edit_message_text("❓ 确认兑换测试商品？", reply_markup=kb, parse_mode='Markdown')
+    await query.message.reply_text(f"📦 **已购内容：**\n`{content}`", parse_mode='Markdown')
+    if fid:
+        try:
+            if ftype == 'photo': await context.bot.send_photo(uid, fid)
+            elif ftype == 'video': await context.bot.send_video(uid, fid)
+        except: pass
+
+async def confirm_buy_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """兑换确认页"""
+    query = update.callback_query
+    await query.answer()
+    uid = update.effective_user.id
+    if context.args[0] == "test":
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton("✅ 确认", callback_data=cb("do_buy", "test")), InlineKeyboardButton("❌ 取消", callback_data=cb("list_prod", 0))]])
+        await safe_edit(query, "❓ 确认兑换测试商品？", reply_markup=kb, parse_mode='Markdown')
         return
-    elif data == "do_buy_test":
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回兑换列表", callback_data="list_prod_0")]])
-        await query.edit_message_text("🎉 兑换成功！内容：哈哈", reply_markup=kb, parse_mode='Markdown')
+    pid = int(context.args[0])
+    prod = await asyncio.to_thread(get_product_details, pid)
+    if not prod:
+        await query.answer("商品已下架", show_alert=True)
         return
-
-    pid = int(data.split("_")[-1])
     
-    if "view_bought_" in data:
-        prod = get_product_details(pid)
-        if not prod:
-            await query.answer("商品不存在", show_alert=True)
-            return
+    is_v, _ = is_vip(uid)
+    _, has_free = check_daily_free(uid)
+    cost_text = f"{prod[2]} 积分"
+    if is_v and has_free: cost_text = "0 积分 (会员特权)"
         
-        content = prod[3] or "无文本"
-        fid = prod[4]
-        ftype = prod[5]
-        
-        await query.message.reply_text(f"📦 **已购内容：**\n`{content}`", parse_mode='Markdown')
-        if fid:
-            try:
-                if ftype == 'photo': await context.bot.send_photo(uid, fid)
-                elif ftype == 'video': await context.bot.send_video(uid, fid)
-            except: pass
-        return
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("✅ 确认兑换", callback_data=cb("do_buy", pid)), InlineKeyboardButton("❌ 取消", callback_data=cb("list_prod", 0))]])
+    await safe_edit(query, f"❓ **确认兑换**\n商品：{prod[1]}\n价格：{cost_text}", reply_markup=kb, parse_mode='Markdown')
 
-    if "confirm_buy_" in data:
-        prod = get_product_details(pid)
-        if not prod:
-            await query.answer("商品已下架", show_alert=True)
-            return
-        
-        is_v, _ = is_vip(uid)
-        _, has_free = check_daily_free(uid)
-        cost_text = f"{prod[2]} 积分"
-        if is_v and has_free: cost_text = "0 积分 (会员特权)"
-            
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("✅ 确认兑换", callback_data=f"do_buy_{pid}"), InlineKeyboardButton("❌ 取消", callback_data="list_prod_0")]])
-        await query.edit_message_text(f"❓ **确认兑换**\n商品：{prod[1]}\n价格：{cost_text}", reply_markup=kb, parse_mode='Markdown')
+async def do_buy_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """扣分 (或使用会员免费次数) 并发货"""
+    query = update.callback_query
+    await query.answer()
+    uid = update.effective_user.id
+    if context.args[0] == "test":
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回兑换列表", callback_data=cb("list_prod", 0))]])
+        await safe_edit(query, "🎉 兑换成功！内容：哈哈", reply_markup=kb, parse_mode='Markdown')
         return
-
-    if "do_buy_" in data:
-        prod = get_product_details(pid)
-        if not prod:
-            await query.answer("商品已下架", show_alert=True)
+    pid = int(context.args[0])
+    prod = await asyncio.to_thread(get_product_details, pid)
+    if not prod:
+        await query.answer("商品已下架", show_alert=True)
+        return
+    
+    is_v, _ = is_vip(uid)
+    price = prod[2]
+    used_free = is_v and use_free_chance(uid)
+    
+    if not used_free:
+        user_pts = get_user_data(uid)[0]
+        if user_pts < price:
+            kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data=cb("list_prod", 0))]])
+            await safe_edit(query, "❌ **余额不足！**\n请充值或赚取更多积分。", reply_markup=kb, parse_mode='Markdown')
             return
+        update_points(uid, -price, f"兑换-{prod[1]}")
         
-        is_v, _ = is_vip(uid)
-        _, has_free = check_daily_free(uid)
-        price = prod[2]
-        
-        if is_v and has_free:
-            use_free_chance(uid)
-        else:
-            user_pts = get_user_data(uid)[0]
-            if user_pts < price:
-                kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="list_prod_0")]])
-                await query.edit_message_text("❌ **余额不足！**\n请充值或赚取更多积分。", reply_markup=kb, parse_mode='Markdown')
-                return
-            update_points(uid, -price, f"兑换-{prod[1]}")
-            
-        record_purchase(uid, pid)
-        
-        await query.message.reply_text(f"🎉 **兑换成功！**\n消耗 {price if not (is_v and has_free) else 0} 积分。\n\n📦 **内容：**\n`{prod[3] or ''}`", parse_mode='Markdown')
-        if prod[4]:
-            try:
-                if prod[5] == 'photo': await context.bot.send_photo(uid, prod[4])
-                elif prod[5] == 'video': await context.bot.send_video(uid, prod[4])
-            except: pass
-        await asyncio.sleep(1)
-        await dh_command(update, context) # 刷新列表
+    record_purchase(uid, pid)
+    
+    await query.message.reply_text(f"🎉 **兑换成功！**\n消耗 {0 if used_free else price} 积分。\n\n📦 **内容：**\n`{prod[3] or ''}`", parse_mode='Markdown')
+    if prod[4]:
+        try:
+            if prod[5] == 'photo': await context.bot.send_photo(uid, prod[4])
+            elif prod[5] == 'video': await context.bot.send_video(uid, prod[4])
+        except: pass
+    await asyncio.sleep(1)
+    context.args = []
+    await dh_command(update, context) # 刷新列表
 
 async def get_quark_key_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """七星密钥入口"""
     query = update.callback_query
     await query.answer()
     
-    row = get_system_keys_v7()
+    row = await asyncio.to_thread(get_system_keys_v7)
     if not row:
         await query.message.reply_text("⏳ 系统初始化中，请稍后再试。")
         return
 
-    kb = []
-    # 百度 x 2
-    row1 = []
-    for i in range(1, 3):
-        if row[i*2]:
-            row1.append(InlineKeyboardButton(f"百度 {i}", url=f"https://{RAILWAY_DOMAIN}/jump?key_index={i}"))
-        else:
-            row1.append(InlineKeyboardButton(f"百度 {i} (空)", callback_data="noop_empty"))
-    kb.append(row1)
-    
-    # 夸克 x 5
-    row2 = []
-    for i in range(3, 6):
-        if row[i*2]:
-            row2.append(InlineKeyboardButton(f"夸克 {i}", url=f"https://{RAILWAY_DOMAIN}/jump?key_index={i}"))
-        else:
-            row2.append(InlineKeyboardButton(f"夸克 {i} (空)", callback_data="noop_empty"))
-    kb.append(row2)
-    
-    row3 = []
-    for i in range(6, 8):
-        if row[i*2]:
-            row3.append(InlineKeyboardButton(f"夸克 {i}", url=f"https://{RAILWAY_DOMAIN}/jump?key_index={i}"))
-        else:
-            row3.append(InlineKeyboardButton(f"夸克 {i} (空)", callback_data="noop_empty"))
-    kb.append(row3)
-    
-    kb.append([InlineKeyboardButton("🔙 返回积分中心", callback_data="my_points")])
-    
-    text = (
-        "🔑 **免费获取解锁密钥**\n\n"
-        "1. 点击下方按钮跳转网盘\n"
-        "2. 保存文件，文件名即为密钥 (如 `KEY123.zip`)\n"
-        "3. 复制文件名 (去掉后缀) 发送给机器人\n"
-        "4. **任意一个密钥** 即可解锁今日兑换权限！\n\n"
-        "⚠️ 注意：每个密钥 7 天内只能使用一次。"
-    )
-    
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
+    present = tuple(bool(row[i * 2]) for i in range(1, 8))
+    await safe_edit(query, QUARK_KEY_TEXT, reply_markup=quark_key_menu(present), parse_mode='Markdown')
 
 async def quark_key_btn_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """旧的单个密钥入口 (保留以防报错，逻辑转接)"""
@@ -1204,46 +2968,150 @@ async def quark_key_btn_handler(update: Update, context: ContextTypes.DEFAULT_TY
 async def admin_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if str(update.effective_user.id) != str(ADMIN_ID):
         return
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🖼 File ID 管理", callback_data="start_upload")],
-        [InlineKeyboardButton("📚 频道转发库", callback_data="manage_cmds_entry")],
-        [InlineKeyboardButton("🛍 商品管理", callback_data="manage_products_entry")],
-        [InlineKeyboardButton("👥 用户与记录", callback_data="list_users")]
-    ])
+    kb = admin_menu()
     if update.callback_query:
-        await update.callback_query.edit_message_text("⚙️ **管理员后台**", reply_markup=kb, parse_mode='Markdown')
+        await update.callback_query.answer()
+        await safe_edit(update.callback_query, "⚙️ **管理员后台**", reply_markup=kb, parse_mode='Markdown')
     else:
         await update.message.reply_text("⚙️ **管理员后台**", reply_markup=kb, parse_mode='Markdown')
     return ConversationHandler.END
 
 async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """用户浏览：/users [ID | @用户名前缀 | vip]，按积分倒序键集翻页"""
     if str(update.effective_user.id) != str(ADMIN_ID):
         return
-    rows, _ = get_all_users_info(20, 0)
-    msg = "👥 **用户列表 (Top 20)**\n\n"
+    query = update.callback_query
+    mode, after = 'a', None
+    if query:
+        await query.answer()
+        if context.args:
+            # users_pg:<模式>[:<积分>:<用户ID>]
+            mode = context.args[0]
+            if len(context.args) == 3:
+                after = (int(context.args[1]), int(context.args[2]))
+    else:
+        arg = " ".join(context.args or []).strip()
+        if arg.isdigit():
+            row = get_user_brief(int(arg))
+            rows = [row] if row else []
+            mode = 'id'
+        elif arg.lower() == "vip":
+            mode = 'v'
+        elif arg:
+            mode = 'p'
+            context.user_data['users_q'] = arg.lstrip("@")
+    
+    if mode != 'id':
+        prefix = context.user_data.get('users_q') if mode == 'p' else None
+        rows = get_users_page(after=after, vip_only=(mode == 'v'), prefix=prefix)
+    
+    title = {'a': "全部", 'v': "会员", 'p': f"@{context.user_data.get('users_q', '')}…", 'id': "ID 查询"}[mode]
+    title = escape_markdown(title)  # 前缀里的 _ * 会破坏 Markdown 解析
+    msg = f"👥 **用户列表 ({title})** · 约 {estimate_users_count()} 人\n\n"
     for r in rows:
         mark = "👑" if r[3] and r[3] > datetime.now() else ""
-        msg += f"ID: `{r[0]}` {mark} | 分: {r[2]}\n"
+        name = f" `@{r[1]}`" if r[1] else ""
+        msg += f"ID: `{r[0]}`{name} {mark} | 分: {r[2]}\n"
+    if not rows:
+        msg += "📭 无匹配用户\n"
+    msg += "\n🔎 /users ID | @前缀 | vip"
+    
+    nav = []
+    if after:
+        nav.append(InlineKeyboardButton("⏮ 首页", callback_data=cb("users_pg", mode)))
+    if mode != 'id' and len(rows) == USERS_PAGE_SIZE:
+        last = rows[-1]
+        nav.append(InlineKeyboardButton("➡️ 下一页", callback_data=cb("users_pg", mode, last[2], last[0])))
+    kb = [nav] if nav else []
+    kb.append([InlineKeyboardButton("🔙 返回后台", callback_data="back_to_admin")])
+    if query:
+        await safe_edit(query, msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
+    else:
+        await update.message.reply_text(msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export users|point_logs|purchases"""
+    if str(update.effective_user.id) != str(ADMIN_ID):
+        return
+    name = (context.args or [""])[0]
+    if name not in EXPORT_TABLES:
+        await update.message.reply_text(f"用法：/export {' | '.join(EXPORT_TABLES)}")
+        return
+    try:
+        f = await asyncio.to_thread(export_table_gzip, name)
+    except Exception as e:
+        logger.warning(f"export {name} failed: {e}")
+        await update.message.reply_text("❌ 导出失败，请稍后重试。")
+        return
+    try:
+        size = f.seek(0, 2)
+        f.seek(0)
+        if size > 45 * 1024 * 1024:
+            msg = "⚠️ 文件超过 Telegram 50MB 限制，请使用 HTTP 导出："
+            if EXPORT_TOKEN and RAILWAY_DOMAIN:
+                msg += f"\nhttps://{RAILWAY_DOMAIN}/admin/export/{name}.csv?{sign_export_link(name)}"
+                msg += f"\n(一次性链接，{EXPORT_LINK_TTL // 60} 分钟内有效)"
+            await update.message.reply_text(msg)
+            return
+        filename = f"{name}_{datetime.now(tz_bj).strftime('%Y%m%d_%H%M')}.csv.gz"
+        await context.bot.send_document(update.effective_chat.id, document=f, filename=filename)
+    except Exception as e:
+        logger.warning(f"export {name} send failed: {e}")
+        await update.message.reply_text("❌ 导出文件发送失败，请稍后重试。")
+    finally:
+        f.close()
+
+async def point_totals_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """全站积分按类别汇总 (物化视图，每小时刷新)"""
+    if str(update.effective_user.id) != str(ADMIN_ID):
+        return
+    query = update.callback_query
+    await query.answer()
+    rows = get_point_category_totals()
+    msg = "📊 **积分汇总 (按类别)**\n\n"
+    for c, t, n, u in rows:
+        msg += f"• {c or '其他'}：{int(t):+d} 分 | {n} 笔 | {u} 人\n"
+    if not rows:
+        msg += "暂无数据\n"
+    msg += "\n⏱ 每小时更新"
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回后台", callback_data="back_to_admin")]])
+    await safe_edit(query, msg, reply_markup=kb, parse_mode='Markdown')
+
+STATS_LABELS = [
+    ('active', "👥 活跃用户"), ('new_user', "🆕 新用户"), ('checkin', "📅 签到"),
+    ('ad_view', "📺 广告观看"), ('recharge', "💎 充值"), ('vip', "👑 开通会员"),
+    ('purchase', "🎁 兑换"), ('points_in', "➕ 发放积分"), ('points_out', "➖ 消耗积分"),
+]
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats 今日与近 7 天运营数据 (读小时汇总表)"""
+    if str(update.effective_user.id) != str(ADMIN_ID):
+        return
+    today = datetime.now(tz_bj).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    day, top = get_stats_totals(today)
+    week, _ = get_stats_totals(today - timedelta(days=6))
+    msg = "📈 **运营数据** (今日 / 近7天)\n\n"
+    for metric, label in STATS_LABELS:
+        msg += f"{label}：{day.get(metric, 0)} / {week.get(metric, 0)}\n"
+    if top:
+        msg += "\n🏆 **今日兑换 Top5：**\n" + "".join(f"• {name or '#' + dim}：{n}\n" for name, dim, n in top)
+    msg += "\n注：7天活跃为每日活跃之和"
     kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回后台", callback_data="back_to_admin")]])
     if update.callback_query:
-        await update.callback_query.edit_message_text(msg, reply_markup=kb, parse_mode='Markdown')
+        await update.callback_query.answer()
+        await safe_edit(update.callback_query, msg, reply_markup=kb, parse_mode='Markdown')
     else:
         await update.message.reply_text(msg, reply_markup=kb, parse_mode='Markdown')
 
 async def manage_products_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("➕ 上架新商品", callback_data="add_product_start")],
-        [InlineKeyboardButton("📂 管理/下架商品", callback_data="list_admin_prods_0")],
-        [InlineKeyboardButton("🔙 返回后台", callback_data="back_to_admin")]
-    ])
-    await query.edit_message_text("🛍 **商品管理**", reply_markup=kb, parse_mode='Markdown')
+    await safe_edit(query, "🛍 **商品管理**", reply_markup=products_menu(), parse_mode='Markdown')
 
 async def add_product_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("📝 请输入 **商品名称**：", parse_mode='Markdown')
+    await safe_edit(query, "📝 请输入 **商品名称**：", parse_mode='Markdown')
     return WAITING_PROD_NAME
 
 async def receive_prod_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1279,100 +3147,139 @@ async def receive_prod_content(update: Update, context: ContextTypes.DEFAULT_TYP
     await update.message.reply_text("✅ **商品上架成功！**", reply_markup=kb, parse_mode='Markdown')
     return ConversationHandler.END
 
+async def import_products_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if str(update.effective_user.id) != str(ADMIN_ID):
+        await query.answer()
+        return ConversationHandler.END
+    await query.answer()
+    await safe_edit(query, 
+        "📥 **批量导入商品**\n\n"
+        "请发送 `.csv` / `.json` / `.jsonl` 文件，字段：\n"
+        "`name, price, content_text, content_file_id, content_type`\n"
+        "content_type 为 text / photo / video，缺省为 text。",
+        parse_mode='Markdown'
+    )
+    return WAITING_PROD_IMPORT
+
+async def receive_prod_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if str(update.effective_user.id) != str(ADMIN_ID):
+        return ConversationHandler.END
+    doc = update.message.document
+    fname = (doc.file_name or "").lower()
+    fmt = fname.rsplit(".", 1)[-1] if "." in fname else ""
+    if fmt not in ("csv", "json", "jsonl"):
+        await update.message.reply_text("❌ 仅支持 .csv / .json / .jsonl，请重新发送：")
+        return WAITING_PROD_IMPORT
+    
+    tg_file = await doc.get_file()
+    with tempfile.TemporaryFile() as f:
+        await tg_file.download_to_memory(out=f)
+        f.seek(0)
+        try:
+            imported, errors = await asyncio.to_thread(import_products_file, f, fmt)
+        except Exception as e:
+            await update.message.reply_text(f"❌ 导入失败，已全部回滚：{e}")
+            return WAITING_PROD_IMPORT
+    
+    msg = f"✅ 已导入 {imported} 个商品"
+    if errors:
+        msg += f"\n⚠️ 跳过 {len(errors)} 行：\n" + "\n".join(f"第 {n} 行：{err}" for n, err in errors[:10])
+        if len(errors) > 10:
+            msg += f"\n… 另有 {len(errors) - 10} 行"
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="manage_products_entry")]])
+    await update.message.reply_text(msg, reply_markup=kb)
+    return ConversationHandler.END
+
 async def list_admin_prods(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    offset = int(query.data.split("_")[-1])
-    rows, total = get_products_list(limit=10, offset=offset)
+    offset = int(context.args[0])
+    rows, total = await asyncio.to_thread(get_products_list, 10, offset)
     
     kb = []
     for r in rows:
-        kb.append([InlineKeyboardButton(f"🗑 下架 {r[1]}", callback_data=f"ask_del_prod_{r[0]}")])
+        kb.append([InlineKeyboardButton(f"🗑 下架 {r[1]}", callback_data=cb("ask_del_prod", r[0]))])
         
     nav = []
     if offset > 0:
-        nav.append(InlineKeyboardButton("⬅️", callback_data=f"list_admin_prods_{offset-10}"))
+        nav.append(InlineKeyboardButton("⬅️", callback_data=cb("list_admin_prods", offset - 10)))
     if offset + 10 < total:
-        nav.append(InlineKeyboardButton("➡️", callback_data=f"list_admin_prods_{offset+10}"))
+        nav.append(InlineKeyboardButton("➡️", callback_data=cb("list_admin_prods", offset + 10)))
     if nav:
         kb.append(nav)
     kb.append([InlineKeyboardButton("🔙 返回", callback_data="manage_products_entry")])
     
-    await query.edit_message_text(f"🛍 **商品列表 ({offset//10 + 1})**", reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
+    await safe_edit(query, f"🛍 **商品列表 ({offset//10 + 1})**", reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
 
 async def ask_del_prod(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    pid = int(query.data.split("_")[-1])
+    pid = int(context.args[0])
     kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ 确认", callback_data=f"confirm_del_prod_{pid}"), InlineKeyboardButton("❌ 取消", callback_data="list_admin_prods_0")]
+        [InlineKeyboardButton("✅ 确认", callback_data=cb("confirm_del_prod", pid)), InlineKeyboardButton("❌ 取消", callback_data=cb("list_admin_prods", 0))]
     ])
-    await query.edit_message_text(f"⚠️ 确认下架商品 ID {pid}?", reply_markup=kb)
+    await safe_edit(query, f"⚠️ 确认下架商品 ID {pid}?", reply_markup=kb)
 
 async def confirm_del_prod(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    pid = int(query.data.split("_")[-1])
+    pid = int(context.args[0])
     delete_product(pid)
     kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="manage_products_entry")]])
-    await query.edit_message_text("🗑 已下架。", reply_markup=kb)
+    await safe_edit(query, "🗑 已下架。", reply_markup=kb)
 
 async def manage_cmds_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("➕ 添加新命令", callback_data="add_new_cmd")],
-        [InlineKeyboardButton("📂 管理/删除命令", callback_data="list_cmds_0")],
-        [InlineKeyboardButton("🔙 返回后台", callback_data="back_to_admin")]
-    ])
-    await query.edit_message_text("📚 **内容管理**", reply_markup=kb, parse_mode='Markdown')
+    await safe_edit(query, "📚 **内容管理**", reply_markup=cmds_menu(), parse_mode='Markdown')
 
 async def list_cmds(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    offset = int(query.data.split('_')[-1])
+    offset = int(context.args[0])
     rows, total = get_commands_list(limit=10, offset=offset)
     
     if not rows:
-        await query.edit_message_text("📭 暂无自定义命令。", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="manage_cmds_entry")]]))
+        await safe_edit(query, "📭 暂无自定义命令。", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="manage_cmds_entry")]]))
         return
         
     kb = []
     for r in rows:
-        kb.append([InlineKeyboardButton(f"🗑 删除 {r[1]}", callback_data=f"ask_del_cmd_{r[0]}")])
+        kb.append([InlineKeyboardButton(f"🗑 删除 {r[1]}", callback_data=cb("ask_del_cmd", r[0]))])
         
     nav = []
     if offset > 0:
-        nav.append(InlineKeyboardButton("⬅️", callback_data=f"list_cmds_{offset-10}"))
+        nav.append(InlineKeyboardButton("⬅️", callback_data=cb("list_cmds", offset - 10)))
     if offset + 10 < total:
-        nav.append(InlineKeyboardButton("➡️", callback_data=f"list_cmds_{offset+10}"))
+        nav.append(InlineKeyboardButton("➡️", callback_data=cb("list_cmds", offset + 10)))
     if nav:
         kb.append(nav)
     kb.append([InlineKeyboardButton("🔙 返回", callback_data="manage_cmds_entry")])
     
-    await query.edit_message_text(f"📂 **命令列表 ({offset//10 + 1})**", reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
+    await safe_edit(query, f"📂 **命令列表 ({offset//10 + 1})**", reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
 
 async def ask_del_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    cmd_id = int(query.data.split('_')[-1])
+    cmd_id = int(context.args[0])
     kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ 确认", callback_data=f"confirm_del_cmd_{cmd_id}"), InlineKeyboardButton("❌ 取消", callback_data="manage_cmds_entry")]
+        [InlineKeyboardButton("✅ 确认", callback_data=cb("confirm_del_cmd", cmd_id)), InlineKeyboardButton("❌ 取消", callback_data="manage_cmds_entry")]
     ])
-    await query.edit_message_text(f"⚠️ **确定删除吗？**", reply_markup=kb, parse_mode='Markdown')
+    await safe_edit(query, f"⚠️ **确定删除吗？**", reply_markup=kb, parse_mode='Markdown')
 
 async def confirm_del_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    cmd_id = int(query.data.split('_')[-1])
+    cmd_id = int(context.args[0])
     delete_command_by_id(cmd_id)
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="list_cmds_0")]])
-    await query.edit_message_text("🗑 **已删除。**", reply_markup=kb, parse_mode='Markdown')
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data=cb("list_cmds", 0))]])
+    await safe_edit(query, "🗑 **已删除。**", reply_markup=kb, parse_mode='Markdown')
 
 async def add_cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("📝 输入新命令名称：", parse_mode='Markdown')
+    await safe_edit(query, "📝 输入新命令名称：", parse_mode='Markdown')
     return WAITING_CMD_NAME
 
 async def receive_cmd_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1410,16 +3317,16 @@ async def finish_cmd_bind(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="manage_cmds_entry")]])
-    await query.edit_message_text("🎉 绑定完成！", reply_markup=kb)
+    await safe_edit(query, "🎉 绑定完成！", reply_markup=kb)
     return ConversationHandler.END
 
 async def my_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if str(update.effective_user.id) != str(ADMIN_ID):
         return
-    info = get_system_keys_v7()
+    info = await asyncio.to_thread(get_system_keys_v7)
     if not info:
-        refresh_system_keys_v7()
-        info = get_system_keys_v7()
+        await asyncio.to_thread(refresh_system_keys_v7)
+        info = await asyncio.to_thread(get_system_keys_v7)
     
     msg = f"👮‍♂️ **密钥管理** ({info[-1]})\n\n"
     for i in range(1, 8):
@@ -1473,16 +3380,23 @@ async def receive_link_7(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start_upload_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
     kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_to_admin")]])
-    await update.callback_query.edit_message_text("📤 发送图片:", reply_markup=kb)
+    await safe_edit(update.callback_query, "📤 发送图片:\n(附言写素材名可直接替换，如 ALI_PAY_QR)", reply_markup=kb)
     return WAITING_FOR_PHOTO
 
 async def handle_photo_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if str(update.effective_user.id) != str(ADMIN_ID):
         return ConversationHandler.END
     p = update.message.photo[-1]
-    save_file_id(p.file_id, p.file_unique_id)
+    asset_key = (update.message.caption or "").strip().upper()
+    if asset_key not in ASSET_KEYS:
+        asset_key = None
+    save_file_id(p.file_id, p.file_unique_id, asset_key)
     kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_to_admin")]])
-    await update.message.reply_text(f"✅ ID:\n`{p.file_id}`", parse_mode='Markdown', reply_markup=kb)
+    msg = f"✅ ID:\n`{p.file_id}`"
+    if asset_key:
+        _assets[asset_key] = p.file_id
+        msg += f"\n🖼 已设为素材 `{asset_key}`"
+    await update.message.reply_text(msg, parse_mode='Markdown', reply_markup=kb)
     return WAITING_FOR_PHOTO
 
 async def view_files_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1491,7 +3405,7 @@ async def view_files_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     fs = get_all_files()
     kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_to_admin")]])
     if not fs:
-        await q.edit_message_text("📭 无记录", reply_markup=kb)
+        await safe_edit(q, "📭 无记录", reply_markup=kb)
         return ConversationHandler.END
     await q.message.reply_text("📂 **列表:**", parse_mode='Markdown')
     for dbid, fid in fs:
@@ -1532,7 +3446,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not text or text.startswith('/'):
         return
     
-    contents = get_command_content(text.strip())
+    contents = await asyncio.to_thread(get_command_content, text.strip())
     if contents:
         sent_msg_ids = []
         chat_id = update.effective_chat.id
@@ -1551,7 +3465,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                     media_group.append(InputMediaVideo(media=item[1]))
             if len(media_group) == len(chunk) and len(media_group) > 1:
                 try:
-                    msgs = await context.bot.send_media_group(chat_id=chat_id, media=media_group)
+                    msgs = await context.bot.send_media_group(chat_id=chat_id, media=media_group, rate_limit_args=FANOUT)
                     sent_msg_ids.extend([m.message_id for m in msgs])
                 except:
                     pass
@@ -1560,26 +3474,26 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                     try:
                         m = None
                         if item[2] == 'text':
-                            m = await context.bot.send_message(chat_id, item[4])
+                            m = await context.bot.send_message(chat_id, item[4], rate_limit_args=FANOUT)
                         elif item[2] == 'photo':
-                            m = await context.bot.send_photo(chat_id, item[1]) # 无 caption
+                            m = await context.bot.send_photo(chat_id, item[1], rate_limit_args=FANOUT) # 无 caption
                         elif item[2] == 'video':
-                            m = await context.bot.send_video(chat_id, item[1])
+                            m = await context.bot.send_video(chat_id, item[1], rate_limit_args=FANOUT)
                         elif item[2] == 'document':
-                            m = await context.bot.send_document(chat_id, item[1])
+                            m = await context.bot.send_document(chat_id, item[1], rate_limit_args=FANOUT)
                         if m:
                             sent_msg_ids.append(m.message_id)
                     except:
                         pass
         
-        success_msg = await context.bot.send_message(chat_id, "✅ **发送完毕**", parse_mode='Markdown')
+        success_msg = await context.bot.send_message(chat_id, "✅ **发送完毕**", parse_mode='Markdown', rate_limit_args=FANOUT)
         sent_msg_ids.append(success_msg.message_id)
         asyncio.create_task(delete_messages_task(chat_id, sent_msg_ids))
         await asyncio.sleep(2)
         await dh_command(update, context)
         return
     
-    success, msg = check_key_valid(user.id, text)
+    success, msg = await asyncio.to_thread(check_key_valid, user.id, text)
     if success:
         await update.message.reply_text("✅ **密钥验证成功！**\n兑换中心已为您解锁。", parse_mode='Markdown')
         await jf_command_handler(update, context)
@@ -1588,42 +3502,74 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     else:
         await start(update, context)
 
+def build_bot_app():
+    """发送请求用大连接池 (HTTP/2 时单连接多路复用)，get_updates 独占一个小池，互不排队"""
+    http_version = "2" if BOT_HTTP2 else "1.1"
+    request = HTTPXRequest(
+        connection_pool_size=BOT_POOL_SIZE, http_version=http_version,
+        connect_timeout=BOT_CONNECT_TIMEOUT, read_timeout=BOT_READ_TIMEOUT,
+        write_timeout=BOT_WRITE_TIMEOUT, pool_timeout=BOT_POOL_TIMEOUT,
+    )
+    updates_request = HTTPXRequest(
+        connection_pool_size=2, http_version=http_version,
+        connect_timeout=BOT_CONNECT_TIMEOUT, read_timeout=BOT_READ_TIMEOUT, pool_timeout=BOT_POOL_TIMEOUT,
+    )
+    builder = (
+        Application.builder().token(BOT_TOKEN)
+        .request(request).get_updates_request(updates_request)
+        .persistence(PostgresPersistence())
+        .rate_limiter(PriorityRateLimiter())
+    )
+    if CONCURRENT_UPDATES > 0:
+        builder = builder.concurrent_updates(CONCURRENT_UPDATES)
+    logger.info(f"bot transport: pool={BOT_POOL_SIZE} http={http_version} concurrent_updates={CONCURRENT_UPDATES}")
+    return builder.build()
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print(f"--- DOMAIN: {RAILWAY_DOMAIN} ---")
     init_db()
     print("DB OK.")
+    try:
+        logger.info(f"known users warmed: {await asyncio.to_thread(warm_known_users)}")
+    except Exception as e:
+        logger.warning(f"warm known users failed: {e}")
     
     if not get_system_keys_v7():
         refresh_system_keys_v7()
     
-    scheduler.add_job(weekly_reset_task, 'cron', day_of_week='mon', hour=0, timezone=tz_bj)
-    scheduler.add_job(daily_reset_task, 'cron', hour=0, minute=0, timezone=tz_bj)
+    # 每个进程都跑的任务；leader 专属任务在 promote_to_leader 中添加
+    scheduler.add_job(flush_clicks_task, 'interval', seconds=CLICK_FLUSH_SECONDS)
+    scheduler.add_job(flush_stats_task, 'interval', seconds=STATS_FLUSH_SECONDS)
     scheduler.start()
     
     global bot_app
-    bot_app = Application.builder().token(BOT_TOKEN).build()
+    bot_app = build_bot_app()
     
     # Handlers Registration
     verify_conv = ConversationHandler(
+        name="verify_conv", persistent=True,
         entry_points=[CallbackQueryHandler(verify_entry, pattern="^start_verify_flow$")],
         states={WAITING_START_ORDER: [CallbackQueryHandler(ask_start_order, pattern="^paid_start$"), MessageHandler(filters.TEXT & ~filters.COMMAND, check_start_order)]},
         fallbacks=[CommandHandler("start", start), CommandHandler("c", cancel_command)], per_message=False
     )
     
     vip_conv = ConversationHandler(
+        name="vip_conv", persistent=True,
         entry_points=[CallbackQueryHandler(buy_vip_card, pattern="^buy_vip_card$")],
         states={WAITING_VIP_ORDER: [CallbackQueryHandler(ask_vip_order, pattern="^paid_vip$"), MessageHandler(filters.TEXT & ~filters.COMMAND, check_vip_order)]},
         fallbacks=[CommandHandler("jf", jf_command_handler), CommandHandler("c", cancel_command)], per_message=False
     )
     
     recharge_conv = ConversationHandler(
+        name="recharge_conv", persistent=True,
         entry_points=[CallbackQueryHandler(recharge_menu, pattern="^go_recharge$"), CallbackQueryHandler(recharge_entry, pattern="^pay_wx|pay_ali$")],
         states={WAITING_RECHARGE_ORDER: [CallbackQueryHandler(ask_recharge_order, pattern="^paid_recharge$"), MessageHandler(filters.TEXT & ~filters.COMMAND, check_recharge_order)]},
         fallbacks=[CommandHandler("jf", jf_command_handler), CallbackQueryHandler(jf_command_handler, pattern="^my_points$"), CommandHandler("c", cancel_command)], per_message=False
     )
     
     cmd_add_conv = ConversationHandler(
+        name="cmd_add_conv", persistent=True,
         entry_points=[CallbackQueryHandler(add_cmd_start, pattern="^add_new_cmd$")],
         states={
             WAITING_CMD_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_cmd_name)],
@@ -1633,6 +3579,7 @@ async def lifespan(app: FastAPI):
     )
     
     key_conv = ConversationHandler(
+        name="key_conv", persistent=True,
         entry_points=[CallbackQueryHandler(start_edit_links, pattern="^edit_links$")],
         states={
             WAITING_LINK_1: [MessageHandler(filters.TEXT, receive_link_1)],
@@ -1647,12 +3594,14 @@ async def lifespan(app: FastAPI):
     )
     
     admin_up_conv = ConversationHandler(
+        name="admin_up_conv", persistent=True,
         entry_points=[CallbackQueryHandler(start_upload_flow, pattern="^start_upload$")],
         states={WAITING_FOR_PHOTO:[MessageHandler(filters.PHOTO, handle_photo_upload), CallbackQueryHandler(admin_entry, pattern="^back_to_admin$")]},
         fallbacks=[CommandHandler("admin", admin_entry), CommandHandler("c", cancel_command)]
     )
     
     prod_conv = ConversationHandler(
+        name="prod_conv", persistent=True,
         entry_points=[CallbackQueryHandler(add_product_start, pattern="^add_product_start$")],
         states={
             WAITING_PROD_NAME: [MessageHandler(filters.TEXT, receive_prod_name)],
@@ -1662,6 +3611,13 @@ async def lifespan(app: FastAPI):
         fallbacks=[CallbackQueryHandler(manage_products_entry, pattern="^manage_products_entry$"), CommandHandler("c", cancel_command)], per_message=False
     )
 
+    prod_import_conv = ConversationHandler(
+        name="prod_import_conv", persistent=True,
+        entry_points=[CallbackQueryHandler(import_products_start, pattern="^import_products_start$")],
+        states={WAITING_PROD_IMPORT: [MessageHandler(filters.Document.ALL, receive_prod_import)]},
+        fallbacks=[CallbackQueryHandler(manage_products_entry, pattern="^manage_products_entry$"), CommandHandler("c", cancel_command)], per_message=False
+    )
+
     bot_app.add_handler(verify_conv)
     bot_app.add_handler(vip_conv)
     bot_app.add_handler(recharge_conv)
@@ -1669,43 +3625,35 @@ async def lifespan(app: FastAPI):
     bot_app.add_handler(key_conv)
     bot_app.add_handler(admin_up_conv)
     bot_app.add_handler(prod_conv)
+    bot_app.add_handler(prod_import_conv)
     
     bot_app.add_handler(CommandHandler("start", start))
-    bot_app.add_handler(CallbackQueryHandler(start, pattern="^back_to_home$"))
-    
     bot_app.add_handler(CommandHandler("jf", jf_command_handler))
-    bot_app.add_handler(CallbackQueryHandler(jf_command_handler, pattern="^my_points$"))
-    bot_app.add_handler(CallbackQueryHandler(noop_handler, pattern="^noop_"))
-    bot_app.add_handler(CallbackQueryHandler(view_balance, pattern="^view_balance$"))
-    
     bot_app.add_handler(CommandHandler("hd", activity_handler))
-    bot_app.add_handler(CallbackQueryHandler(activity_handler, pattern="^open_activity$"))
-    bot_app.add_handler(CallbackQueryHandler(checkin_handler, pattern="^do_checkin$"))
-    bot_app.add_handler(CallbackQueryHandler(quark_key_btn_handler, pattern="^get_quark_key$"))
-    bot_app.add_handler(CallbackQueryHandler(get_quark_key_entry, pattern="^get_quark_key_v7$"))
-    
     bot_app.add_handler(CommandHandler("dh", dh_command))
-    bot_app.add_handler(CallbackQueryHandler(dh_command, pattern="^go_exchange$"))
-    bot_app.add_handler(CallbackQueryHandler(dh_command, pattern="^list_prod_"))
-    bot_app.add_handler(CallbackQueryHandler(exchange_handler, pattern="^confirm_buy_|do_buy_|view_bought_"))
-    
     bot_app.add_handler(CommandHandler("admin", admin_entry))
-    bot_app.add_handler(CallbackQueryHandler(admin_entry, pattern="^back_to_admin$"))
-    bot_app.add_handler(CallbackQueryHandler(manage_cmds_entry, pattern="^manage_cmds_entry$"))
-    bot_app.add_handler(CallbackQueryHandler(list_cmds, pattern="^list_cmds_"))
-    bot_app.add_handler(CallbackQueryHandler(ask_del_cmd, pattern="^ask_del_cmd_"))
-    bot_app.add_handler(CallbackQueryHandler(confirm_del_cmd, pattern="^confirm_del_cmd_"))
-    
-    bot_app.add_handler(CallbackQueryHandler(manage_products_entry, pattern="^manage_products_entry$"))
-    bot_app.add_handler(CallbackQueryHandler(list_admin_prods, pattern="^list_admin_prods_"))
-    bot_app.add_handler(CallbackQueryHandler(ask_del_prod, pattern="^ask_del_prod_"))
-    bot_app.add_handler(CallbackQueryHandler(confirm_del_prod, pattern="^confirm_del_prod_"))
-    
     bot_app.add_handler(CommandHandler("my", my_command))
     bot_app.add_handler(CommandHandler("cz", cz_command))
     bot_app.add_handler(CommandHandler("users", list_users))
-    
-    bot_app.add_handler(CallbackQueryHandler(list_users, pattern="^list_users$"))
+    bot_app.add_handler(CommandHandler("export", export_command))
+    bot_app.add_handler(CommandHandler("stats", stats_command))
+    
+    # 会话之外的所有按钮：单个处理器 + 路由表
+    CALLBACK_ROUTES.update({
+        "back_to_home": start, "locked_verify": start,
+        "my_points": jf_command_handler, "noop": noop_handler, "view_balance": view_balance,
+        "open_activity": activity_handler, "do_checkin": checkin_handler,
+        "get_quark_key": quark_key_btn_handler, "get_quark_key_v7": get_quark_key_entry,
+        "go_exchange": dh_command, "list_prod": dh_command,
+        "confirm_buy": confirm_buy_handler, "do_buy": do_buy_handler, "view_bought": view_bought_handler,
+        "back_to_admin": admin_entry, "manage_cmds_entry": manage_cmds_entry,
+        "list_cmds": list_cmds, "ask_del_cmd": ask_del_cmd, "confirm_del_cmd": confirm_del_cmd,
+        "manage_products_entry": manage_products_entry, "list_admin_prods": list_admin_prods,
+        "ask_del_prod": ask_del_prod, "confirm_del_prod": confirm_del_prod,
+        "stats": stats_command, "list_users": list_users, "users_pg": list_users,
+        "point_totals": point_totals_admin,
+    })
+    bot_app.add_handler(CallbackQueryHandler(route_callback))
     
     # 新增通用退出命令
     bot_app.add_handler(CommandHandler("c", cancel_command))
@@ -1714,13 +3662,31 @@ async def lifespan(app: FastAPI):
 
     await bot_app.initialize()
     await bot_app.start()
-    await bot_app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    await load_asset_registry()
+    election = None
+    if CLUSTER_MODE:
+        election = asyncio.create_task(leader_election_loop())
+    else:
+        await promote_to_leader()
     
     yield
+    if election:
+        election.cancel()
+    if _leader["active"]:
+        await demote_from_leader()
+    if _leader["conn"]:
+        _leader["conn"].close()
+    if _listener["conn"]:
+        asyncio.get_running_loop().remove_reader(_listener["conn"].fileno())
+        _listener["conn"].close()
     if bot_app:
+        await drain_admin_notices()
         await bot_app.stop()
         await bot_app.shutdown()
     scheduler.shutdown()
+    await flush_clicks_task()
+    await flush_stats_task()
+    close_db_pools()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -1796,15 +3762,16 @@ async def vad(p: dict):
     
     res = process_ad_reward(uid)
     if res["status"] == "success":
+        bump_stat('ad_view')
         try:
-            await bot_app.bot.send_message(chat_id=uid, text=f"🎉 **恭喜！** 观看完成，获得 {res['added']} 积分！", parse_mode='Markdown')
+            await bot_app.bot.send_message(chat_id=uid, text=f"🎉 **恭喜！** 观看完成，获得 {res['added']} 积分！", parse_mode='Markdown', rate_limit_args={"priority": PRIO_FOLLOWUP})
         except:
             pass
     return JSONResponse({"success": True, "points": res.get("added", 0), "message": res.get("status")})
 
 @app.get("/jump")
 async def jump(key_index: int = 1):
-    row = get_system_keys_v7()
+    row = await asyncio.to_thread(get_system_keys_v7)
     if not row: return HTMLResponse("<h1>System Error</h1>")
     
     link_idx = key_index * 2; raw_target = row[link_idx]
@@ -1826,6 +3793,52 @@ setTimeout(() => window.location.href = "TARGET_URL", 3000);
 """
     return HTMLResponse(content=html.replace("AD_URL", DIRECT_LINK_1).replace("TARGET_URL", target))
 
+def check_admin_token(request):
+    """令牌只从请求头读取，不出现在 URL (访问日志、聊天记录) 里"""
+    token = request.headers.get("X-Export-Token", "")
+    return bool(EXPORT_TOKEN) and hmac.compare_digest(token.encode(), EXPORT_TOKEN.encode())
+
+# --- 一次性导出链接 ---
+# 用 EXPORT_TOKEN 对 (表名, 过期时间, nonce) 做 HMAC 签名；用过的 nonce 记在进程内，
+# 多 worker 时每个进程最多各用一次，靠短有效期兜底。
+_used_export_nonces = {}  # nonce -> 过期时间戳
+
+def _export_sig(name, exp, nonce):
+    return hmac.new(EXPORT_TOKEN.encode(), f"{name}:{exp}:{nonce}".encode(), "sha256").hexdigest()
+
+def sign_export_link(name):
+    exp, nonce = int(time.time()) + EXPORT_LINK_TTL, uuid.uuid4().hex
+    return f"exp={exp}&nonce={nonce}&sig={_export_sig(name, exp, nonce)}"
+
+def redeem_export_link(name, exp, nonce, sig):
+    now = time.time()
+    if not EXPORT_TOKEN or not nonce or exp < now or nonce in _used_export_nonces:
+        return False
+    if not hmac.compare_digest(sig.encode(), _export_sig(name, exp, nonce).encode()):
+        return False
+    for k in [k for k, v in _used_export_nonces.items() if v < now]:
+        del _used_export_nonces[k]
+    _used_export_nonces[nonce] = exp
+    return True
+
+@app.get("/api/stats")
+async def stats_api(request: Request, hours: int = 24):
+    if not check_admin_token(request):
+        return JSONResponse({"success": False, "message": "Forbidden"}, status_code=403)
+    since = stat_bucket() - timedelta(hours=max(1, min(hours, 24 * 31)) - 1)
+    rows = await asyncio.to_thread(get_stats_series, since)
+    series = [{"bucket": b.isoformat(), "metric": m, "dim": d, "value": v} for b, m, d, v in rows]
+    return JSONResponse({"success": True, "timezone": "Asia/Shanghai", "series": series})
+
+@app.get("/admin/export/{name}.csv")
+async def export_csv(name: str, request: Request, exp: int = 0, nonce: str = "", sig: str = ""):
+    if not (check_admin_token(request) or redeem_export_link(name, exp, nonce, sig)):
+        return JSONResponse({"success": False, "message": "Forbidden"}, status_code=403)
+    if name not in EXPORT_TABLES:
+        return JSONResponse({"success": False, "message": "Unknown table"}, status_code=404)
+    filename = f"{name}_{datetime.now(tz_bj).strftime('%Y%m%d_%H%M')}.csv"
+    return StreamingResponse(stream_table_csv(name), media_type="text/csv", headers={"Content-Disposition": f"attachment; filename={filename}"})
+
 @app.get("/ad_success")
 async def success_page(points: int = 0):
     return HTMLResponse(content=f"<html><body><h1>🎉 成功! +{points}分</h1></body></html>")
@@ -1875,4 +3888,4 @@ function start() {
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run("main:app", host="0.0.0.0", port=port)
+    uvicorn.run("main:app", host="0.0.0.0", port=port, workers=WEB_CONCURRENCY)